@@ -0,0 +1,26 @@
+"""
+Micro-benchmarks for super_csv.
+
+Run a benchmark from the repository root, e.g.::
+
+    python -m benchmarks.bench_commit
+"""
+
+import os
+import timeit
+
+
+def setup_django():
+    """
+    Configure Django with the test settings so processors can be imported.
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_settings')
+    import django  # pylint: disable=import-outside-toplevel
+    django.setup()
+
+
+def best_of(func, repeat=5):
+    """
+    Return the fastest of ``repeat`` runs of ``func``, in seconds.
+    """
+    return min(timeit.repeat(func, number=1, repeat=repeat))
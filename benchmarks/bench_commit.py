@@ -0,0 +1,38 @@
+"""
+Benchmark CSVProcessor.commit() and rollback() against the number of staged rows.
+
+Time per row should stay flat as the row count grows.
+"""
+
+from benchmarks import best_of, setup_django
+
+setup_django()
+
+from super_csv.csv_processor import CSVProcessor  # pylint: disable=wrong-import-position
+
+
+class NoopProcessor(CSVProcessor):
+    columns = ['user_id', 'grade']
+
+    def process_row(self, row):
+        return True, row
+
+
+def run(num_rows):
+    """
+    Stage ``num_rows`` rows, then commit and roll them back.
+    """
+    processor = NoopProcessor()
+    processor.stage.extend((rownum, {'user_id': rownum, 'grade': 1}) for rownum in range(1, num_rows + 1))
+    processor.commit()
+    processor.rollback()
+
+
+def main():
+    for num_rows in (10_000, 50_000, 200_000):
+        elapsed = best_of(lambda n=num_rows: run(n), repeat=3)
+        print(f'{num_rows:>8} rows: {elapsed:.3f}s ({elapsed / num_rows * 1e6:.2f} us/row)')
+
+
+if __name__ == '__main__':
+    main()
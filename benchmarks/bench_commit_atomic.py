@@ -0,0 +1,53 @@
+"""
+Benchmark committing rows that write to the database, with and without commit_atomic.
+
+Runs against a temporary SQLite file, where each autocommitted row is a separate
+transaction. Savings on MySQL/InnoDB depend on its flush settings.
+"""
+
+import os
+import tempfile
+
+from benchmarks import best_of, setup_django
+
+setup_django()
+
+# pylint: disable=wrong-import-position
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+
+from super_csv.csv_processor import CSVProcessor
+
+
+class UserProcessor(CSVProcessor):
+    columns = ['username']
+
+    def process_row(self, row):
+        get_user_model().objects.create(username=row['username'])
+        return True, None
+
+
+def run(num_rows, commit_atomic):
+    """
+    Stage ``num_rows`` rows and commit them, each creating a user.
+    """
+    get_user_model().objects.all().delete()
+    processor = UserProcessor(commit_atomic=commit_atomic)
+    processor.stage.extend((rownum, {'username': f'user{rownum}'}) for rownum in range(1, num_rows + 1))
+    processor.commit()
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        settings.DATABASES['default']['NAME'] = os.path.join(tmpdir, 'bench.db')
+        call_command('migrate', verbosity=0)
+        num_rows = 2000
+        for commit_atomic in (False, True):
+            elapsed = best_of(lambda atomic=commit_atomic: run(num_rows, atomic), repeat=3)
+            print(f'commit_atomic={commit_atomic!s:<5} {num_rows} rows: {elapsed:.3f}s '
+                  f'({num_rows / elapsed:,.0f} rows/s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Benchmark CSV export: get_iterator() against get_buffered_iterator(),
+which writes through UnicodeDictWriter into a bytes buffer.
+"""
+
+from benchmarks import best_of, setup_django
+
+setup_django()
+
+from super_csv.csv_processor import CSVProcessor  # pylint: disable=wrong-import-position
+
+NUM_ROWS = 200_000
+
+
+class GradeExportProcessor(CSVProcessor):
+    columns = ['user_id', 'username', 'course_id', 'grade']
+
+    def get_rows_to_export(self):
+        for i in range(NUM_ROWS):
+            yield {'user_id': i, 'username': f'learner{i}', 'course_id': 'course-v1:edX+DemoX+Demo', 'grade': 0.5}
+
+
+def consume(chunks):
+    """
+    Encode and count the output like a WSGI server would.
+    """
+    num_chunks = size = 0
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        num_chunks += 1
+        size += len(chunk)
+    return num_chunks, size
+
+
+def main():
+    processor = GradeExportProcessor()
+    assert b''.join(processor.get_buffered_iterator()) == ''.join(processor.get_iterator()).encode('utf-8')
+    timings = {
+        'get_iterator': processor.get_iterator,
+        'get_buffered_iterator': processor.get_buffered_iterator,
+        'get_buffered_iterator gzip': lambda: processor.get_buffered_iterator(gzip=True),
+    }
+    for name, iterator in timings.items():
+        num_chunks, size = consume(iterator())
+        elapsed = best_of(lambda i=iterator: consume(i()), repeat=3)
+        print(f'{name:>27}: {NUM_ROWS / elapsed:,.0f} rows/s, {num_chunks:,} chunks, {size:,} bytes')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Benchmark the memory used by staged rows and results after preprocessing
+a wide file, with dict rows, compact rows and compact results.
+"""
+
+import io
+import tracemalloc
+
+from benchmarks import setup_django
+
+setup_django()
+
+from super_csv.csv_processor import CSVProcessor  # pylint: disable=wrong-import-position
+
+NUM_ROWS = 20_000
+NUM_COLUMNS = 40
+
+
+class WideProcessor(CSVProcessor):
+    max_file_size = 0
+
+
+def make_file():
+    header = ['user_id'] + [f'assignment_{i}' for i in range(NUM_COLUMNS)]
+    lines = [','.join(header)]
+    for i in range(NUM_ROWS):
+        lines.append(','.join([str(i)] + [str(j % 7) for j in range(NUM_COLUMNS)]))
+    return ('\r\n'.join(lines) + '\r\n').encode('utf-8')
+
+
+def stage(contents, **kwargs):
+    """
+    Preprocess the file, returning the processor and the bytes allocated for it.
+    """
+    tracemalloc.start()
+    processor = WideProcessor(**kwargs)
+    processor.process_file(io.BytesIO(contents), autocommit=False)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return processor, size
+
+
+def main():
+    contents = make_file()
+    print(f'{len(contents):,} bytes, {NUM_ROWS:,} rows, {NUM_COLUMNS + 1} columns')
+    for kwargs in ({}, {'compact_rows': True}, {'compact_results': True},
+                   {'compact_rows': True, 'compact_results': True}):
+        processor, size = stage(contents, **kwargs)
+        assert len(processor.stage) == NUM_ROWS
+        print(f'{kwargs!s:>48}: {size / 1024 / 1024:.1f} MiB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+Benchmark reading a wide CSV file where the processor uses few of the columns:
+csv.DictReader over decode_utf8 against ProjectedReader over decode_utf8_blocks.
+
+Reads 50,000 rows of 63 unquoted columns, 3 of them used, from memory. With
+CPython 3.11 on a shared Linux VM, six runs measured speedups of 1.9-2.5x,
+each the best of 5 reads. Single reads varied more, down to about 1.5x.
+"""
+
+import io
+
+from benchmarks import best_of, setup_django
+
+setup_django()
+
+from super_csv.csv_processor import CSVProcessor  # pylint: disable=wrong-import-position
+
+NUM_ROWS = 50_000
+NUM_COLUMNS = 60
+
+
+class WideProcessor(CSVProcessor):
+    columns = ['user_id', 'username', 'grade']
+    max_file_size = 0
+
+
+def make_file():
+    header = ['user_id', 'username'] + [f'assignment_{i}' for i in range(NUM_COLUMNS)] + ['grade']
+    lines = [','.join(header)]
+    for i in range(NUM_ROWS):
+        lines.append(','.join([str(i), f'learner{i}'] + ['0.75'] * NUM_COLUMNS + ['0.5']))
+    return ('\r\n'.join(lines) + '\r\n').encode('utf-8')
+
+
+def read(contents, projected_reader):
+    processor = WideProcessor(projected_reader=projected_reader)
+    return sum(1 for __ in processor.read_file(io.BytesIO(contents)))
+
+
+def main():
+    contents = make_file()
+    print(f'{len(contents):,} bytes, {NUM_ROWS:,} rows, {NUM_COLUMNS + 3} columns')
+    timings = {}
+    for projected_reader in (False, True):
+        assert read(contents, projected_reader) == NUM_ROWS
+        timings[projected_reader] = elapsed = best_of(lambda p=projected_reader: read(contents, p), repeat=5)
+        print(f'projected_reader={projected_reader!s:>5}: {NUM_ROWS / elapsed:,.0f} rows/s')
+    print(f'speedup: {timings[False] / timings[True]:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
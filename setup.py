@@ -146,6 +146,12 @@ setup(
     ],
     include_package_data=True,
     install_requires=load_requirements('requirements/base.in'),
+    extras_require={
+        # DeferrableMixin.state_codec = 'msgpack'
+        'msgpack': ['msgpack'],
+        # CSV_STORAGE_COMPRESSION = 'zstd'
+        'zstd': ['zstandard'],
+    },
     license="Apache 2.0",
     zip_safe=False,
     keywords='Django edx',
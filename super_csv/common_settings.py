@@ -6,3 +6,5 @@ Common settings for super_csv
 def plugin_settings(settings):
     # expire stored CSV data after 90 days
     settings.CSV_EXPIRATION_DAYS = 90
+    # compress stored CSV data: None, 'gzip' or 'zstd'
+    settings.CSV_STORAGE_COMPRESSION = None
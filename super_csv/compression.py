@@ -0,0 +1,88 @@
+"""
+Compression of stored CSVOperation data.
+
+The method is chosen with settings.CSV_STORAGE_COMPRESSION when writing,
+and detected from the data header when reading, so uncompressed data still loads.
+"""
+
+import gzip
+import shutil
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def _check_zstd():
+    if zstandard is None:
+        raise ImproperlyConfigured('zstd compression requires the zstandard package')
+
+
+def compress(data, method=None):
+    """
+    Compress the bytes with the method ('gzip', 'zstd' or None),
+    which defaults to settings.CSV_STORAGE_COMPRESSION.
+    """
+    if method is None:
+        method = getattr(settings, 'CSV_STORAGE_COMPRESSION', None)
+    if not method:
+        return data
+    if method == 'gzip':
+        return gzip.compress(data, compresslevel=6, mtime=0)
+    if method == 'zstd':
+        _check_zstd()
+        return zstandard.ZstdCompressor().compress(data)
+    raise ImproperlyConfigured(f'Unknown CSV_STORAGE_COMPRESSION: {method!s}')
+
+
+def decompress(data):
+    """
+    Decompress the bytes if they start with a gzip or zstd header.
+    """
+    if data.startswith(GZIP_MAGIC):
+        return gzip.decompress(data)
+    if data.startswith(ZSTD_MAGIC):
+        _check_zstd()
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+def compress_file(src, dst, method=None):
+    """
+    Compress the binary file src into the binary file dst, a block at a time,
+    with the method as for compress().
+    """
+    if method is None:
+        method = getattr(settings, 'CSV_STORAGE_COMPRESSION', None)
+    if not method:
+        shutil.copyfileobj(src, dst)
+    elif method == 'gzip':
+        with gzip.GzipFile(fileobj=dst, mode='wb', compresslevel=6, mtime=0) as compressed:
+            shutil.copyfileobj(src, compressed)
+    elif method == 'zstd':
+        _check_zstd()
+        zstandard.ZstdCompressor().copy_stream(src, dst)
+    else:
+        raise ImproperlyConfigured(f'Unknown CSV_STORAGE_COMPRESSION: {method!s}')
+
+
+def open_decompressed(fileobj):
+    """
+    Return a binary file object reading fileobj, decompressing it
+    if it starts with a gzip or zstd header.
+    """
+    header = fileobj.read(len(ZSTD_MAGIC))
+    fileobj.seek(0)
+    if header.startswith(GZIP_MAGIC):
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    if header.startswith(ZSTD_MAGIC):
+        _check_zstd()
+        return zstandard.ZstdDecompressor().stream_reader(fileobj)
+    return fileobj
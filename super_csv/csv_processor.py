@@ -2,65 +2,77 @@
 Generic class-based CSV Processor.
 """
 
+import codecs
 import csv
 import logging
-from collections import defaultdict
-from io import StringIO
+import multiprocessing
+import pickle
+import sys
+import tempfile
+import time
+import zlib
+from collections import defaultdict, deque
+from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from io import BytesIO, StringIO, TextIOWrapper
+from itertools import chain, islice
 
+from django.db import connections, transaction
+from django.db.models import QuerySet
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.query import ValuesIterable
+from django.utils import translation
 from django.utils.translation import gettext as _
 
 from .exceptions import ValidationError
 from .mixins import ChecksumMixin, DeferrableMixin
+from .row_ranges import RowRanges
+from .workers import activate_language, init_preprocess_worker, preprocess_in_worker
 
 log = logging.getLogger(__name__)
 
 __all__ = ('CSVProcessor', 'ChecksumMixin', 'DeferrableMixin', 'ValidationError')
 
+READ_BLOCK_SIZE = 256 * 1024
+# copies of uploads kept for compact_results are spooled to disk above this size
+UPLOAD_SPOOL_SIZE = 1024 * 1024
 
-class UnicodeWriter:
+
+class _TextWriter(TextIOWrapper):
     """
-    A CSV writer which will write rows to CSV file "f",
-    which is encoded in the given encoding.
+    A text wrapper that leaves its binary stream open when closed or garbage collected.
+    """
+
+    def close(self):
+        if not self.closed:
+            self.flush()
 
-    https://docs.python.org/2/library/csv.html
+
+class UnicodeWriter:
+    """
+    A CSV writer which will write rows to the binary stream "f",
+    encoded in the given encoding.
     """
 
-    def __init__(self, f, dialect=csv.excel, **kwds):
-        # Redirect output to a queue
-        self.queue = StringIO()
-        self.writer = csv.writer(self.queue, dialect=dialect, **kwds)
-        self.stream = f
+    def __init__(self, f, dialect=csv.excel, encoding='utf-8', **kwds):
+        self.stream = _TextWriter(f, encoding=encoding, newline='', write_through=True)
+        self.writer = csv.writer(self.stream, dialect=dialect, **kwds)
 
     def writerow(self, row):
         """
         Write the row
         """
-        newrow = []
-        for col in row:
-            if col is None:
-                col = ''
-            elif not isinstance(col, str):
-                col = str(col)
-            newrow.append(col.encode('utf8'))
-        self.writer.writerow(newrow)
-        # Fetch UTF-8 output from the queue ...
-        data = self.queue.getvalue()
-        data = data.decode("utf-8")
-        # write to the target stream
-        self.stream.write(data)
-        # empty queue
-        self.queue.truncate(0)
-        return data
+        return self.writer.writerow(row)
 
     def writerows(self, rows):
-        for row in rows:
-            self.writerow(row)
+        return self.writer.writerows(rows)
 
 
 class UnicodeDictWriter(csv.DictWriter):
     """
-    A CSV writer which will write rows to CSV file "f",
-    which is encoded in the given encoding.
+    A CSV writer which will write dict rows to the binary stream "f",
+    encoded in the given encoding.
     """
 
     # pylint: disable=super-init-not-called, keyword-arg-before-vararg, too-many-positional-arguments
@@ -83,6 +95,117 @@ class ResultDict(dict):
             self['status'] = _('Success')
 
 
+class _Missing:
+    """
+    The value of a key deleted from a Row. Pickles as the module's one instance,
+    so rows sent to worker processes keep their deleted keys deleted.
+    """
+    __slots__ = ()
+
+    def __reduce__(self):
+        return '_MISSING'
+
+    def __repr__(self):
+        return '<missing>'
+
+
+_MISSING = _Missing()
+
+
+class RowHeader:
+    """
+    Column names shared by the compact rows of a file.
+    """
+    __slots__ = ('names', 'index', '_result_header')
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.index = {name: position for position, name in enumerate(self.names)}
+        self._result_header = None
+
+    def get_result_header(self):
+        """
+        Return the header of result rows, which adds the error and status columns.
+        """
+        if self._result_header is None:
+            self._result_header = RowHeader(
+                self.names + [name for name in ('error', 'status') if name not in self.index]
+            )
+        return self._result_header
+
+
+class Row(MutableMapping):
+    """
+    A compact, dict-like row: a list of values with a header shared by all rows.
+    Keys that aren't in the header are kept in a per-row dict.
+
+    copy() returns a plain dict, and the state codecs save rows as dicts.
+    """
+    __slots__ = ('header', '_values', '_extra')
+
+    def __init__(self, header, values):
+        self.header = header
+        self._values = values
+        self._extra = None
+
+    def __getitem__(self, key):
+        position = self.header.index.get(key)
+        if position is not None:
+            value = self._values[position]
+            if value is not _MISSING:
+                return value
+        elif self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        position = self.header.index.get(key)
+        if position is not None:
+            self._values[position] = value
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        position = self.header.index.get(key)
+        if position is not None and self._values[position] is not _MISSING:
+            self._values[position] = _MISSING
+        elif self._extra is not None and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __iter__(self):
+        for name, value in zip(self.header.names, self._values):
+            if value is not _MISSING:
+                yield name
+        if self._extra:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(value is not _MISSING for value in self._values) + len(self._extra or ())
+
+    def __repr__(self):
+        return f'Row({dict(self)!r})'
+
+    def copy(self):
+        return dict(self)
+
+    def get_result(self):
+        """
+        Return a copy of the row with error and status columns, like ResultDict.
+        """
+        header = self.header.get_result_header()
+        result = Row(header, self._values + [_MISSING] * (len(header.names) - len(self._values)))
+        if self._extra:
+            result._extra = dict(self._extra)  # pylint: disable=protected-access
+        if 'error' not in result:
+            result['error'] = ''
+            result['status'] = _('Success')
+        return result
+
+
 class Echo:
     """An object that implements just the write method of the file-like
     interface.
@@ -92,6 +215,28 @@ class Echo:
         return value
 
 
+def accepts_gzip(request):
+    """
+    Return whether the client of the Django request accepts gzip-encoded responses.
+
+    gzip is accepted if it, or else the * wildcard, is listed in Accept-Encoding
+    with a q-value above 0. Invalid q-values count as 0.
+    """
+    qvalues = {}
+    for encoding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        name, *params = [part.strip() for part in encoding.split(';')]
+        qvalue = 1.0
+        for param in params:
+            key, __, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        qvalues.setdefault(name.lower(), qvalue)
+    return qvalues.get('gzip', qvalues.get('*', 0.0)) > 0
+
+
 def decode_utf8(input_iterator):
     """
     Generator that decodes a utf-8 encoded
@@ -101,6 +246,153 @@ def decode_utf8(input_iterator):
         yield line if isinstance(line, str) else line.decode('utf-8')
 
 
+def decode_utf8_blocks(thefile, block_size=READ_BLOCK_SIZE):
+    """
+    Generator that decodes a utf-8 encoded file in blocks of block_size bytes,
+    with an incremental decoder, and yields it line by line.
+
+    Falls back to decode_utf8 for inputs that can't be read in blocks.
+    """
+    read = getattr(thefile, 'read', None)
+    if read is None:
+        yield from decode_utf8(thefile)
+        return
+    decode = codecs.getincrementaldecoder('utf-8')().decode
+    tail = ''
+    while True:
+        block = read(block_size)
+        if not block:
+            break
+        lines = (tail + (block if isinstance(block, str) else decode(block))).split('\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    tail += decode(b'', final=True)
+    if tail:
+        yield tail
+
+
+class _UploadCopy:
+    """
+    Wraps an uploaded file, copying what is read from it to a spooled temporary file,
+    so the upload is kept without being read twice or seeked.
+    """
+
+    def __init__(self, thefile):
+        self._file = thefile
+        # kept by the processor after the file is read
+        self.copy = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE)  # pylint: disable=consider-using-with
+
+    def _write(self, data):
+        self.copy.write(data.encode('utf-8') if isinstance(data, str) else data)
+        return data
+
+    def __iter__(self):
+        for line in self._file:
+            yield self._write(line)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            # also keeps lookups from recursing before _file is set
+            raise AttributeError(name)
+        attr = getattr(self._file, name)
+        if name == 'read':
+            return lambda *args: self._write(attr(*args))
+        return attr
+
+
+class ProjectedReader:
+    """
+    A CSV reader, like csv.DictReader, which maps only the given columns of each row.
+
+    The column positions are found once from the header. Columns missing from the
+    header are left out of the rows, and values missing from short rows are None.
+    Lines without quotes are split directly; the others are parsed with csv.reader.
+
+    columns=None maps every column of the header. If compact is set, rows are Row objects.
+    """
+
+    def __init__(self, lines, columns=None, compact=False):
+        self.lines = iter(lines)
+        self._pending = None
+        self.reader = csv.reader(self._feed())
+        self.fieldnames = self._next_row() or []
+        positions = {}
+        for position, name in enumerate(self.fieldnames):
+            positions.setdefault(name, position)
+        if columns is None:
+            columns = positions
+        self.columns = [name for name in columns if name in positions]
+        self.positions = [positions[name] for name in self.columns]
+        self._min_size = max(self.positions, default=-1) + 1
+        self.header = RowHeader(self.columns) if compact else None
+
+    def _feed(self):
+        """
+        Feed the quoted line to csv.reader, then any continuation lines of multi-line fields.
+        """
+        while True:
+            if self._pending is not None:
+                line, self._pending = self._pending, None
+            else:
+                line = next(self.lines, None)
+                if line is None:
+                    return
+            yield line
+
+    def _next_row(self):
+        """
+        Return the values of the next row that isn't blank, or None at the end of the file.
+        """
+        for line in self.lines:
+            if '"' in line:
+                self._pending = line
+                row = next(self.reader)
+            else:
+                line = line.rstrip('\r\n')
+                row = line.split(',') if line else []
+            if row:
+                return row
+        return None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = self._next_row()
+        if row is None:
+            raise StopIteration
+        if len(row) >= self._min_size:
+            values = [row[pos] for pos in self.positions]
+        else:
+            size = len(row)
+            values = [row[pos] if pos < size else None for pos in self.positions]
+        if self.header is not None:
+            return Row(self.header, values)
+        return dict(zip(self.columns, values))
+
+
+def _init_preprocess_thread(language, worker_connections):
+    """
+    Set up a preprocessing worker thread: activate the caller's language
+    and collect the thread's database connections, to close them when the pool is done.
+    """
+    activate_language(language)
+    worker_connections.extend(connections.all())
+
+
+def _close_worker_connections(worker_connections):
+    """
+    Close the database connections of finished worker threads, from the calling thread.
+    """
+    for connection in worker_connections:
+        connection.inc_thread_sharing()
+        try:
+            connection.close()
+        finally:
+            connection.dec_thread_sharing()
+
+
 class CSVProcessor:
     """
     Generic CSV processor.
@@ -124,24 +416,95 @@ class CSVProcessor:
     columns = []
     required_columns = []
     max_file_size = 2 * 1024 * 1024
+    # read files in big blocks, keeping only the get_read_columns() of each row
+    projected_reader = False
+    # keep rows as compact Row objects, with one header shared by all rows
+    compact_rows = False
+    # keep only the error messages and row numbers of failed rows, instead of a result per row,
+    # and produce result reports and status() error rows by reading the upload again
+    compact_results = False
+    # number of staged rows passed to each process_rows() call
+    commit_batch_size = 100
+    # save each batch in one transaction, with a savepoint per row, see process_rows()
+    commit_atomic = False
+    # commit rows while reading the file, see stream_file()
+    streaming = False
+    stream_window_size = 1000
+    # validate and preprocess rows in a pool of 'thread' or 'process' workers; 0 means serially
+    preprocess_workers = 0
+    preprocess_executor = 'thread'
+    preprocess_chunk_size = 1000
+    # stop reading the file once this many rows failed validation; 0 means never
+    abort_max_errors = 0
+    # stop reading the file once this many consecutive rows failed validation; 0 means never
+    abort_consecutive_errors = 0
+    # stop reading the file once more than this fraction of the rows read failed validation,
+    # checked after abort_min_rows rows; None means never
+    abort_max_error_ratio = None
+    abort_min_rows = 100
+    # how often commit() calls report_progress()
+    progress_interval_rows = 1000
+    progress_interval_seconds = 5
+    # number of rows passed to each preprocess_export_rows() call
+    export_batch_size = 1000
+    # approximate size of the chunks yielded by get_buffered_iterator()
+    export_chunk_size = 64 * 1024
+    # querysets to export are read in chunks of this many rows, selecting only the exported fields
+    export_queryset_chunk_size = 2000
+    export_values_projection = True
+    # number of threads formatting export shards, see get_export_shards()
+    export_workers = 0
 
     def __init__(self, **kwargs):
         self.filename = ''  # represents original imported file
         self.total_rows = 0
         self.processed_rows = 0
         self.saved_rows = 0
-        self.stage = []
-        self.rollback_rows = []
+        self.stage = deque()
+        self.rollback_rows = deque()
         self.result_data = []
-        self.error_messages = defaultdict(list)
+        self.error_messages = defaultdict(RowRanges)
+        self.no_action_rows = RowRanges()
+        # whether reading the file stopped early, see _should_abort()
+        self.truncated = False
+        # the copy of the upload being read, and the kept upload, with compact_results
+        self._upload_copy = None
+        self._upload = None
+        # results of the streaming window being committed, see _commit_window()
+        self._window_results = None
+        # counts of the running commit, see _start_progress()
+        self._progress = None
         for key, value in kwargs.items():
+            if key in ('stage', 'rollback_rows'):
+                # saved state is loaded back as lists
+                value = deque(value)
+            elif key == 'no_action_rows':
+                value = RowRanges.from_saved(value)
+            elif key == 'error_messages':
+                value = defaultdict(RowRanges, {
+                    message: RowRanges.from_saved(rows) for message, rows in value.items()
+                })
             setattr(self, key, value)
 
+    def __getstate__(self):
+        """
+        Leave the upload files, which can't be pickled, out of the state
+        pickled for worker processes.
+        """
+        state = self.__dict__.copy()
+        state['_upload_copy'] = state['_upload'] = None
+        return state
+
     def add_error(self, message, row=0):
         """
-        Add an error message. Does not store duplicates.
+        Add an error message for the row number. Does not store duplicate messages.
+
+        Returns the interned message, so the results of rows failing with
+        the same message can share one string.
         """
+        message = sys.intern(message)
         self.error_messages[message].append(row)
+        return message
 
     def write_file(self, thefile, rows=None, columns=None):
         """
@@ -150,46 +513,261 @@ class CSVProcessor:
         for row in self.get_iterator(rows, columns):
             thefile.write(row)
 
-    def get_iterator(self, rows=None, columns=None, error_data=False):
+    def get_iterator(self, rows=None, columns=None, error_data=False, errors_only=False):
         """
         Generate row data for writing to an output CSV file.
 
         Supply rows (dict array) to override output row data.
         Supply columns (string array) to override output columns from processor.
         Set error_data to a truthy value to return error and status info per-row.
+        Set errors_only as well to return only the failed rows.
+        """
+        rows, columns, shards = self._get_export_rows(rows, columns, error_data, errors_only)
+        writer = csv.DictWriter(Echo(), columns, extrasaction="ignore")
+        header = writer.writerow(dict(zip(writer.fieldnames, writer.fieldnames)))
+        yield header
+        if shards is not None:
+            yield from self._iter_formatted_shards(shards, columns, binary=False)
+            return
+        for block in self._iter_export_blocks(rows):
+            for row in block:
+                yield writer.writerow(row)
+
+    # pylint: disable=too-many-positional-arguments
+    def get_buffered_iterator(self, rows=None, columns=None, error_data=False, chunk_size=None, gzip=False,
+                              errors_only=False):
+        """
+        Generate UTF-8 encoded output CSV data in chunks of about chunk_size bytes,
+        for a StreamingHttpResponse.
+
+        Takes the same rows, columns, error_data and errors_only arguments as get_iterator.
+        chunk_size defaults to export_chunk_size.
+        If gzip is truthy, the output is gzip-compressed on the fly; the caller
+        must then set the Content-Encoding: gzip header (see accepts_gzip).
         """
+        rows, columns, shards = self._get_export_rows(rows, columns, error_data, errors_only)
+        chunk_size = chunk_size or self.export_chunk_size
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if gzip else None
+        buf = BytesIO()
+        writer = UnicodeDictWriter(buf, columns, extrasaction="ignore")
+        writer.writeheader()
+        if shards is not None:
+            pieces, write = self._iter_formatted_shards(shards, columns, binary=True), buf.write
+        else:
+            pieces, write = self._iter_export_blocks(rows), writer.writerows
+        for piece in pieces:
+            write(piece)
+            if buf.tell() >= chunk_size:
+                chunk = buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+                if compressor:
+                    chunk = compressor.compress(chunk)
+                if chunk:
+                    yield chunk
+        chunk = buf.getvalue()
+        if compressor:
+            chunk = compressor.compress(chunk) + compressor.flush()
+        if chunk:
+            yield chunk
+
+    def _get_export_rows(self, rows, columns, error_data, errors_only=False):
+        """
+        Return the rows, columns and shards to export, applying the defaults for get_iterator.
+        shards is None unless the shards from get_export_shards() are formatted in
+        parallel, on export_workers threads; rows is then None.
+        """
+        shards = None
+        if columns is None:
+            columns = self.columns
         if error_data:
-            if columns is None:
-                columns = self.columns
             columns = columns + ['status', 'error']
             if rows is None:
-                rows = self.result_data
-        else:
-            if columns is None:
-                columns = self.columns
-            if rows is None:
+                rows = self._get_result_rows(errors_only)
+            elif errors_only:
+                rows = (row for row in rows if row.get('error'))
+        elif rows is None:
+            shards = self.get_export_shards()  # pylint: disable=assignment-from-none
+            if shards is None:
                 rows = self.get_rows_to_export()
+            elif self.export_workers < 2:
+                rows = chain.from_iterable(self._get_shard_export_rows(shard, columns) for shard in shards)
+                shards = None
+        if isinstance(rows, QuerySet):
+            rows = self._iter_queryset_rows(rows, columns)
+        return rows, columns, shards
 
-        writer = csv.DictWriter(Echo(), columns, extrasaction="ignore")
-        header = writer.writerow(dict(zip(writer.fieldnames, writer.fieldnames)))
-        yield header
-        for row in rows:
-            self.preprocess_export_row(row)
-            yield writer.writerow(row)
+    def _get_shard_export_rows(self, shard, columns):
+        """
+        Return the rows of an export shard, reading querysets like get_rows_to_export().
+        """
+        rows = self.get_shard_rows_to_export(shard)
+        if isinstance(rows, QuerySet):
+            rows = self._iter_queryset_rows(rows, columns)
+        return rows
+
+    def _iter_formatted_shards(self, shards, columns, binary):
+        """
+        Format the shards as CSV data (without header) in a pool of export_workers threads.
+        Yields one str, or UTF-8 encoded bytes if binary, per shard, in the order of the shards.
+        At most two shards per worker are formatted ahead of the consumer.
+        """
+        def format_shard(shard):
+            try:
+                rows = self._get_shard_export_rows(shard, columns)
+                buf = BytesIO() if binary else StringIO()
+                writer = (UnicodeDictWriter if binary else csv.DictWriter)(buf, columns, extrasaction="ignore")
+                for block in self._iter_export_blocks(rows):
+                    writer.writerows(block)
+                return buf.getvalue()
+            finally:
+                # this thread's database connections
+                connections.close_all()
+
+        executor = ThreadPoolExecutor(self.export_workers)
+        pending = deque()
+        try:
+            for shard in shards:
+                pending.append(executor.submit(format_shard, shard))
+                if len(pending) >= 2 * self.export_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    def _iter_queryset_rows(self, queryset, columns):
+        """
+        Iterate over the queryset as dicts, in chunks of export_queryset_chunk_size,
+        using a server-side cursor where the database supports it.
+
+        If export_values_projection is set, only the fields from get_export_fields() are selected.
+        """
+        if self.export_values_projection:
+            model_fields = {name for field in queryset.model._meta.concrete_fields
+                            for name in (field.name, field.attname)}
+            model_fields.update(queryset.query.annotations)
+            queryset = queryset.values(*[
+                name for name in self.get_export_fields(columns)
+                if name in model_fields or LOOKUP_SEP in name
+            ])
+        elif queryset._iterable_class is not ValuesIterable:  # pylint: disable=protected-access
+            queryset = queryset.values()
+        return queryset.iterator(chunk_size=self.export_queryset_chunk_size)
+
+    def get_export_fields(self, columns):
+        """
+        Return the names of the fields needed to export the columns, for queryset projection.
+        """
+        return list(columns)
+
+    def _iter_export_blocks(self, rows):
+        """
+        Yield the rows in preprocessed blocks of up to export_batch_size rows.
+        """
+        rows = iter(rows)
+        while True:
+            block = list(islice(rows, self.export_batch_size or 1))
+            if not block:
+                break
+            self.preprocess_export_rows(block)
+            yield block
 
     def process_file(self, thefile, autocommit=True):
         """
         Read the file, validating and preprocessing each row.
         If autocommit=False, rows will be staged for writing. Call commit() to finalize.
         If autocommit=True, the staged rows will be committed.
+
+        If self.streaming is set and autocommit=True, rows are committed
+        as the file is read; see stream_file().
         """
+        if self.compact_results:
+            thefile = self._upload_copy = _UploadCopy(thefile)
         reader = self.read_file(thefile)
         if reader:
+            if self.streaming and autocommit:
+                self.stream_file(reader)
+                thefile.close()
+                return
             self.preprocess_file(reader)
             thefile.close()
             if autocommit and self.can_commit:
                 self.commit()
 
+    def _keep_upload(self):
+        """
+        Keep the copy of the upload made while reading it, once all its rows were read.
+        """
+        upload_copy = self._upload_copy
+        if upload_copy is not None:
+            self._upload_copy = None
+            upload_copy.copy.seek(0)
+            self.store_upload(upload_copy.copy)
+
+    def store_upload(self, upload):
+        """
+        Keep the contents of the uploaded file, a binary file object, to produce result reports from.
+
+        Only called for files that were accepted by read_file().
+        """
+        self._upload = upload
+
+    def get_upload(self):
+        """
+        Return a binary file object reading the uploaded file from the start,
+        or None if it wasn't kept. Files other than the one kept in memory are
+        closed by the caller.
+        """
+        upload = self._upload
+        if upload is not None:
+            upload.seek(0)
+        return upload
+
+    def _get_result_rows(self, errors_only=False):
+        """
+        Return the result rows, with their status and error.
+
+        With compact_results, the rows are read from the upload and joined
+        with the statuses of the failed and unprocessed rows.
+        """
+        upload = self.get_upload() if self.compact_results else None
+        if upload is None:
+            if errors_only:
+                return (row for row in self.result_data if row.get('error'))
+            return self.result_data
+        return self._iter_upload_results(upload, errors_only)
+
+    def _iter_upload_results(self, upload, errors_only):
+        """
+        Read the upload again, yielding each row with its status and error.
+        Stops after total_rows rows, as later rows weren't read if reading was truncated.
+        The upload is closed when done, unless it's the copy kept in memory.
+        """
+        failure, no_action, success = _('Failure'), _('No Action'), _('Success')
+        # (start, end, error) of each range of rows without success, walked in row order
+        spans = [(start, end, message) for message, rows in self.error_messages.items() for start, end in rows.ranges]
+        if not errors_only:
+            spans.extend((start, end, '') for start, end in self.no_action_rows.ranges)
+        spans.sort()
+        position = 0
+        try:
+            rows = islice(csv.DictReader(decode_utf8_blocks(upload)), self.total_rows)
+            for rownum, row in enumerate(rows, 1):
+                while position < len(spans) and spans[position][1] < rownum:
+                    position += 1
+                if position < len(spans) and spans[position][0] <= rownum:
+                    error = spans[position][2]
+                    row['error'], row['status'] = error, failure if error else no_action
+                elif errors_only:
+                    continue
+                else:
+                    row['error'], row['status'] = '', success
+                yield row
+        finally:
+            if upload is not self._upload:
+                upload.close()
+
     # pylint: disable=inconsistent-return-statements
     def read_file(self, thefile):
         """
@@ -200,38 +778,205 @@ class CSVProcessor:
         """
         try:
             self.filename = getattr(thefile, 'name', '') or ''
-            reader = csv.DictReader(decode_utf8(thefile))
+            if self.projected_reader or self.compact_rows:
+                reader = ProjectedReader(
+                    decode_utf8_blocks(thefile),
+                    self.get_read_columns() if self.projected_reader else None,
+                    compact=self.compact_rows,
+                )
+            else:
+                reader = csv.DictReader(decode_utf8(thefile))
             self.validate_file(thefile, reader)
             return reader
         except ValidationError as exc:
             self.add_error(str(exc))
 
+    def get_read_columns(self):
+        """
+        Return the columns read from each row by the projected reader.
+        """
+        read_columns = list(self.columns)
+        read_columns.extend(name for name in self.required_columns if name not in read_columns)
+        return read_columns
+
     def preprocess_file(self, reader):
         """
         Preprocess the rows, saving them to the staging list.
         """
         rownum = processed_rows = 0
         snapshot = []
-        failure = _('Failure')
-        no_action = _('No Action')
-        for rownum, row in enumerate(reader, 1):
-            result = ResultDict(row)
-            try:
-                self.validate_row(row)
-                row = self.preprocess_row(row)
-                if row:
+        for rownum, result, row in self._preprocess_rows(reader):
+            if result['error']:
+                result['error'] = self.add_error(result['error'], rownum)
+            elif row:
+                self.stage.append((rownum, row))
+                processed_rows += 1
+            elif self.compact_results:
+                self.no_action_rows.append(rownum)
+            if not self.compact_results:
+                snapshot.append(result)
+        self.result_data = snapshot
+        self.total_rows = rownum
+        self.processed_rows = processed_rows
+        self._keep_upload()
+
+    def stream_file(self, reader):
+        """
+        Validate, preprocess and commit the rows in windows of stream_window_size rows.
+
+        Unlike preprocess_file() followed by commit(), valid rows are committed
+        even if other rows fail validation, and only the failed rows are kept
+        in result_data, so the staged rows and results don't grow with the size
+        of the file. The undo rows of saved rows are still kept in rollback_rows.
+        """
+        rownum = processed_rows = saved = 0
+        window = {}
+        self._start_progress(None)
+        try:
+            for rownum, result, row in self._preprocess_rows(reader):
+                if result['error']:
+                    result['error'] = self.add_error(result['error'], rownum)
+                elif row:
                     self.stage.append((rownum, row))
                     processed_rows += 1
-                else:
-                    result['status'] = no_action
-            except ValidationError as e:
-                self.add_error(str(e), rownum)
-                result['error'] = str(e)
-                result['status'] = failure
-            snapshot.append(result)
-        self.result_data = snapshot
+                elif self.compact_results:
+                    self.no_action_rows.append(rownum)
+                window[rownum] = result
+                if len(window) >= self.stream_window_size:
+                    saved += self._commit_window(window)
+            saved += self._commit_window(window)
+        finally:
+            self._progress = None
         self.total_rows = rownum
         self.processed_rows = processed_rows
+        self.saved_rows = saved
+        self._keep_upload()
+        log.info('%r streamed %d rows, committed %d rows', self, rownum, saved)
+
+    def _commit_window(self, window):
+        """
+        Commit the staged rows of a streaming window, then keep only its failed results.
+        Returns the number of saved rows.
+        """
+        saved = 0
+        self._window_results = window
+        try:
+            while self.stage:
+                saved += self._process_batch(self._next_batch(self.stage), committing=True)
+        finally:
+            self._window_results = None
+        if not self.compact_results:
+            self.result_data.extend(result for result in window.values() if result['error'])
+        window.clear()
+        return saved
+
+    def _preprocess_rows(self, reader):
+        """
+        Validate and preprocess each row of the reader, in order.
+        Yields (rownum, result, row), where row is the preprocessed row or None.
+
+        If preprocess_workers is set, rows are handed to a pool of that many
+        workers (threads or processes, per preprocess_executor) in chunks of
+        preprocess_chunk_size rows.
+
+        Stops reading the reader, setting truncated, once one of the abort_*
+        limits on failed rows is reached.
+        """
+        if self.preprocess_workers:
+            processed = self._preprocess_parallel(reader)
+        else:
+            processed = map(self._preprocess_one, reader)
+        errors = consecutive_errors = 0
+        for rownum, (result, row) in enumerate(processed, 1):
+            yield rownum, result, row
+            if result['error']:
+                errors += 1
+                consecutive_errors += 1
+            else:
+                consecutive_errors = 0
+            if self._should_abort(rownum, errors, consecutive_errors):
+                self.truncated = True
+                self.add_error(_("Stopped reading the file after {} rows: too many errors").format(rownum))
+                log.info('%r stopped reading after %d rows, %d errors', self, rownum, errors)
+                if hasattr(processed, 'close'):
+                    # shut the workers down without reading further chunks
+                    processed.close()
+                break
+
+    def _should_abort(self, rownum, errors, consecutive_errors):
+        """
+        Return whether to stop reading the file after rownum rows, errors of which failed,
+        the last consecutive_errors of them in a row.
+        """
+        if self.abort_max_errors and errors >= self.abort_max_errors:
+            return True
+        if self.abort_consecutive_errors and consecutive_errors >= self.abort_consecutive_errors:
+            return True
+        return (
+            self.abort_max_error_ratio is not None
+            and rownum >= self.abort_min_rows
+            and errors / rownum > self.abort_max_error_ratio
+        )
+
+    def _preprocess_parallel(self, reader):
+        """
+        Map _preprocess_one over the reader with a thread or process pool.
+
+        Workers use the caller's language. Worker processes are spawned rather
+        than forked, so they don't share the caller's database connections, and
+        set Django up from DJANGO_SETTINGS_MODULE. The database connections of
+        worker threads are closed when the pool is done.
+        """
+        language = translation.get_language()
+        worker_connections = []
+        if self.preprocess_executor == 'process':
+            # the processor is pickled once per worker process
+            executor = ProcessPoolExecutor(
+                self.preprocess_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_preprocess_worker,
+                initargs=(pickle.dumps(self), language),
+            )
+            func = preprocess_in_worker
+            chunksize = max(1, self.preprocess_chunk_size // self.preprocess_workers)
+        elif self.preprocess_executor == 'thread':
+            executor = ThreadPoolExecutor(
+                self.preprocess_workers,
+                initializer=_init_preprocess_thread,
+                initargs=(language, worker_connections),
+            )
+            func = self._preprocess_one
+            chunksize = 1
+        else:
+            raise ValueError(f'preprocess_executor ({self.preprocess_executor!s}) must be \'thread\' or \'process\'')
+        try:
+            with executor:
+                while True:
+                    chunk = list(islice(reader, self.preprocess_chunk_size))
+                    if not chunk:
+                        break
+                    yield from executor.map(func, chunk, chunksize=chunksize)
+        finally:
+            _close_worker_connections(worker_connections)
+
+    def _preprocess_one(self, row):
+        """
+        Validate and preprocess a single row.
+        Returns (result, row), where row is the preprocessed row or None.
+
+        Must not change the state of the processor, because it may run in a worker.
+        """
+        result = row.get_result() if isinstance(row, Row) else ResultDict(row)
+        try:
+            self.validate_row(row)
+            row = self.preprocess_row(row)
+            if not row:
+                result['status'] = _('No Action')
+        except ValidationError as e:
+            row = None
+            result['error'] = str(e)
+            result['status'] = _('Failure')
+        return result, row
 
     def validate_file(self, thefile, reader):
         """
@@ -260,6 +1005,14 @@ class CSVProcessor:
         Returns a row.
         """
 
+    def preprocess_export_rows(self, rows):
+        """
+        Preprocess a block of up to export_batch_size rows just before writing to CSV.
+        Override this to handle the whole block at once.
+        """
+        for row in rows:
+            self.preprocess_export_row(row)
+
     def preprocess_row(self, row):
         """
         Preprocess the row.
@@ -270,9 +1023,29 @@ class CSVProcessor:
     def get_rows_to_export(self):
         """
         Subclasses should implement this to return rows to export.
+
+        Rows may be a list or generator of dicts, or a queryset, which is
+        streamed from the database (see export_queryset_chunk_size).
         """
         return []
 
+    def get_export_shards(self):
+        """
+        Subclasses may implement this to export in shards, e.g. ranges of user ids.
+        Returns a list of shard keys, in output order, or None to use get_rows_to_export.
+
+        Each shard's rows come from get_shard_rows_to_export. With export_workers > 1,
+        shards are fetched and formatted concurrently, and the output is the same.
+        """
+        return None
+
+    def get_shard_rows_to_export(self, shard):
+        """
+        Subclasses that implement get_export_shards should implement this
+        to return the rows to export for the shard.
+        """
+        raise NotImplementedError()
+
     @property
     def can_commit(self):
         """
@@ -285,20 +1058,14 @@ class CSVProcessor:
         Commit the processed rows to the database.
         """
         saved = 0
-        while self.stage:
-            rownum, row = self.stage.pop(0)
-            try:
-                did_save, rollback_row = self.process_row(row)
-                if did_save:
-                    saved += 1
-                    if rollback_row:
-                        self.rollback_rows.append((rownum, rollback_row))
-            except Exception as e:  # pylint: disable=broad-exception-caught
-                log.exception('Committing %r', self)
-                self.add_error(str(e), row=rownum)
-                if self.result_data:
-                    self.result_data[rownum - 1]['error'] = str(e)
-                    self.result_data[rownum - 1]['status'] = _('Failure')
+        self._start_progress(len(self.stage))
+        try:
+            while self.stage:
+                batch = self._next_batch(self.stage)
+                saved += self._process_batch(batch, committing=True)
+                self.checkpoint(batch[-1][0], saved)
+        finally:
+            self._progress = None
         self.saved_rows = saved
         log.info('%r committed %d rows', self, saved)
 
@@ -308,16 +1075,117 @@ class CSVProcessor:
         """
         saved = 0
         while self.rollback_rows:
-            rownum, row = self.rollback_rows.pop(0)
-            try:
-                did_save, __ = self.process_row(row)
-                if did_save:
-                    saved += 1
-            except Exception as e:  # pylint: disable=broad-exception-caught
-                log.exception('Rolling back %r', self)
-                self.add_error(str(e), row=rownum)
+            saved += self._process_batch(self._next_batch(self.rollback_rows), committing=False)
         self.saved_rows = saved
 
+    def _next_batch(self, queue):
+        """
+        Pop up to commit_batch_size (rownum, row) pairs off the front of the queue.
+        """
+        size = min(self.commit_batch_size or 1, len(queue))
+        return [queue.popleft() for __ in range(size)]
+
+    def _process_batch(self, batch, committing):
+        """
+        Save a batch of (rownum, row) pairs with process_rows().
+        Returns the number of saved rows.
+
+        If commit_atomic is set, the batch is saved in one transaction, which is
+        rolled back, failing every row of the batch, if process_rows() raises.
+
+        Failures are recorded against their own row numbers. When committing,
+        undo rows are queued on rollback_rows and failures are marked in result_data.
+        """
+        try:
+            with transaction.atomic() if self.commit_atomic else nullcontext():
+                results = self.process_rows([row for __, row in batch])
+            if len(results) != len(batch):
+                raise ValueError(f'process_rows returned {len(results)} results for {len(batch)} rows')
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            log.exception('%s %r', 'Committing' if committing else 'Rolling back', self)
+            results = [e] * len(batch)
+        saved = 0
+        for (rownum, __), result in zip(batch, results):
+            if isinstance(result, Exception):
+                message = self.add_error(str(result), row=rownum)
+                row_result = self._get_result(rownum) if committing else None
+                if row_result is not None:
+                    row_result['error'] = message
+                    row_result['status'] = _('Failure')
+                continue
+            did_save, rollback_row = result
+            if did_save:
+                saved += 1
+                if committing and rollback_row:
+                    self.rollback_rows.append((rownum, rollback_row))
+        if committing:
+            self._update_progress(len(batch), saved)
+        return saved
+
+    def _start_progress(self, total):
+        """
+        Start tracking commit progress for total staged rows (None if unknown).
+        """
+        now = time.monotonic()
+        self._progress = {
+            'total': total,
+            'processed': 0,
+            'saved': 0,
+            'started': now,
+            'reported_at': now,
+            'reported_rows': 0,
+        }
+
+    def _update_progress(self, processed, saved):
+        """
+        Count committed rows, calling report_progress() every progress_interval_rows
+        rows or progress_interval_seconds seconds.
+        """
+        progress = self._progress
+        if progress is None:
+            return
+        progress['processed'] += processed
+        progress['saved'] += saved
+        now = time.monotonic()
+        if (progress['processed'] - progress['reported_rows'] < self.progress_interval_rows
+                and now - progress['reported_at'] < self.progress_interval_seconds):
+            return
+        progress['reported_at'] = now
+        progress['reported_rows'] = progress['processed']
+        elapsed = now - progress['started']
+        self.report_progress({
+            'total': progress['total'],
+            'processed': progress['processed'],
+            'saved': progress['saved'],
+            'errors': sum(len(rows) for rows in self.error_messages.values()),
+            'rows_per_second': round(progress['processed'] / elapsed, 1) if elapsed else None,
+        })
+
+    def checkpoint(self, rownum, saved):
+        """
+        Called by commit() after each batch, with the number of the last committed
+        row and the number of rows saved so far.
+        """
+
+    def report_progress(self, progress):
+        """
+        Publish commit progress while commit() runs.
+
+        progress is a dict with total (staged rows, or None when streaming),
+        processed, saved, errors and rows_per_second.
+        """
+
+    def _get_result(self, rownum):
+        """
+        Return the result_data entry for the row number, or None if it isn't in memory.
+        """
+        window = self._window_results
+        if window is not None:
+            return window.get(rownum)
+        if 0 < rownum <= len(self.result_data):
+            return self.result_data[rownum - 1]
+        return None
+
     def status(self):
         """
         Return a status dict.
@@ -326,10 +1194,11 @@ class CSVProcessor:
             'total': self.total_rows,
             'processed': self.processed_rows,
             'saved': self.saved_rows,
-            'error_rows': [row for row in self.result_data if row.get('error')],
+            'error_rows': [dict(row) for row in self._get_result_rows(errors_only=True)],
             'error_messages': list(self.error_messages.keys()),
             'percentage': format(self.saved_rows / float(self.total_rows or 1), '.1%'),
             'can_commit': self.can_commit,
+            'truncated': self.truncated,
         }
         return result
 
@@ -341,3 +1210,26 @@ class CSVProcessor:
         At minimun should implement this method.
         """
         return False, None
+
+    def process_rows(self, rows):
+        """
+        Save a batch of up to commit_batch_size rows to the database.
+        Returns a list with one entry per row, in order: either the (success, undo)
+        pair that process_row would return, or the exception raised for that row.
+        If this raises, every row in the batch fails with that error.
+
+        Override this to write the whole batch at once, e.g. with bulk_create.
+
+        If commit_atomic is set, each row is saved in a savepoint, so a failing
+        row is rolled back without aborting the transaction of its batch.
+        """
+        savepoint = transaction.atomic if self.commit_atomic else nullcontext
+        results = []
+        for row in rows:
+            try:
+                with savepoint():
+                    results.append(self.process_row(row))
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                log.exception('Processing row for %r', self)
+                results.append(e)
+        return results
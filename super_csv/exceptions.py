@@ -5,3 +5,7 @@ Super CSV exceptions
 
 class ValidationError(ValueError):
     pass
+
+
+class StateCodecError(ValueError):
+    pass
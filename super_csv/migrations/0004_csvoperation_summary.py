@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('super_csv', '0003_csvoperation_original_filename'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='csvoperation',
+            name='processed_rows',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='csvoperation',
+            name='saved_rows',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='csvoperation',
+            name='total_rows',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
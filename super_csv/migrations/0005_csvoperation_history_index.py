@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('super_csv', '0004_csvoperation_summary'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='csvoperation',
+            index=models.Index(fields=['class_name', 'unique_id', 'operation', 'created'], name='super_csv_history_idx'),
+        ),
+    ]
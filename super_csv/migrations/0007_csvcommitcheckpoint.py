@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:07
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('super_csv', '0006_csvoperation_modified_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CSVCommitCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_row', models.PositiveIntegerField()),
+                ('saved_rows', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('operation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='checkpoints', to='super_csv.csvoperation')),
+            ],
+            options={
+                'ordering': ['operation', 'last_row'],
+            },
+        ),
+    ]
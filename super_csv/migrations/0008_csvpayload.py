@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:08
+
+from django.db import migrations, models
+
+import super_csv.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('super_csv', '0007_csvcommitcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CSVPayload',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('data', models.FileField(max_length=255, upload_to=super_csv.models.csv_payload_path)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='csvoperation',
+            name='payloads',
+            field=models.ManyToManyField(blank=True, related_name='operations', to='super_csv.csvpayload'),
+        ),
+    ]
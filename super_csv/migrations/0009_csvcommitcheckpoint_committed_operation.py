@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('super_csv', '0008_csvpayload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='csvcommitcheckpoint',
+            name='committed_operation',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='super_csv.csvoperation'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:49
+
+from django.db import migrations, models
+
+
+def mark_expired(apps, schema_editor):
+    """
+    Mark the operations whose data was already expired, which had their data field cleared.
+    """
+    CSVOperation = apps.get_model('super_csv', 'CSVOperation')
+    CSVOperation.objects.filter(data='').update(expired=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('super_csv', '0009_csvcommitcheckpoint_committed_operation'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='csvoperation',
+            name='super_csv_modified_idx',
+        ),
+        migrations.AddField(
+            model_name='csvoperation',
+            name='expired',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='csvoperation',
+            index=models.Index(fields=['expired', 'modified'], name='super_csv_expiry_idx'),
+        ),
+        migrations.RunPython(mark_expired, migrations.RunPython.noop),
+    ]
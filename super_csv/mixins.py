@@ -9,39 +9,127 @@ DeferrableMixin handles asynchronous processing.
 import hashlib
 import importlib
 import logging
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import islice
 
-import simplejson as json
-from celery import shared_task
+from celery import chord, shared_task
 from celery.result import AsyncResult
 from celery_utils.logged_task import LoggedTask
 from crum import get_current_user
 from django.conf import settings
+from django.core.cache import cache
 from django.db import DatabaseError, transaction
 from django.utils.translation import gettext as _
 from edx_django_utils.monitoring import set_code_owner_attribute
 
 from .exceptions import ValidationError
-from .models import CSVOperation
+from .models import CSVCommitCheckpoint, CSVOperation, CSVPayload
+from .row_ranges import RowRanges
 from .serializers import CSVOperationSerializer
+from .state_codecs import decode_state, encode_state
 
 log = logging.getLogger(__name__)
 
+# state keys saved as CSVPayloads when DeferrableMixin.split_payload is set
+PAYLOAD_KEYS = ('stage', 'result_data')
+
+# celery task state used to publish commit progress
+PROGRESS_STATE = 'PROGRESS'
+# held by the task committing an operation, so a redelivered task doesn't commit it twice.
+# Each checkpoint renews it, so it only expires if the task stops running.
+COMMIT_LOCK_KEY = 'super_csv.commit.{}.lock'
+COMMIT_LOCK_TIMEOUT = 15 * 60
+# seconds before a task that found the commit lock held runs again
+COMMIT_LOCK_RETRY_DELAY = 60
+# version 2 checksums are prefixed with their version
+KEYED_CHECKSUM_PREFIX = '@v2:'
+KEYED_CHECKSUM_SEPARATOR = '\x1f'
+
+
+@lru_cache
+def _get_keyed_hash(secret):
+    """
+    Get the initial keyed hash state for the secret. Copy it to hash each row.
+    """
+    key = hashlib.blake2b(secret.encode('utf8'), digest_size=32, person=b'super_csv').digest()
+    return hashlib.blake2b(key=key, digest_size=16)
+
+
+def _index_result_errors(results, error_messages):
+    """
+    Replace the error of each failed result with the position of its message
+    in error_messages, so saved results don't repeat the message of every row.
+    """
+    positions = {message: position for position, message in enumerate(error_messages)}
+    return [
+        {**result, 'error': positions[result['error']]} if result.get('error') in positions else result
+        for result in results
+    ]
+
+
+def _restore_result_errors(results, error_messages):
+    """
+    Put back the messages of results saved by _index_result_errors().
+    """
+    messages = list(error_messages)
+    for result in results:
+        if isinstance(result.get('error'), int):
+            result['error'] = messages[result['error']]
+
 
 class ChecksumMixin:
     """
     CSV mixin that will create and verify a checksum column in the CSV file
     Specify a list checksum_columns in the subclass.
+
+    Set checksum_version = 2 to export keyed-hash checksums, which look like @v2:xxxx.
+    Version 1 checksums (@xxxx) are always accepted on import.
     """
     secret = settings.SECRET_KEY
     checksum_columns = []
     checksum_fieldname = 'csum'
     checksum_size = 4
+    checksum_version = 1
+
+    def _get_checksum(self, row, version=None):
+        """
+        Get the checksum of one row, like _get_checksums().
+        """
+        values = ['' if row[key] is None else str(row[key]) for key in self.checksum_columns]
+        if (version or self.checksum_version) == 2:
+            row_hash = _get_keyed_hash(self.secret).copy()
+            row_hash.update(KEYED_CHECKSUM_SEPARATOR.join(values).encode('utf8'))
+            return KEYED_CHECKSUM_PREFIX + row_hash.hexdigest()[:self.checksum_size]
+        to_check = ''.join(values) + self.secret
+        return '@' + hashlib.md5(to_check.encode('utf8')).hexdigest()[:self.checksum_size]
 
-    def _get_checksum(self, row):
-        to_check = ''.join(str(row[key] if row[key] is not None else '') for key in self.checksum_columns)
-        to_check += self.secret
-        checksum = hashlib.md5(to_check.encode('utf8')).hexdigest()[:self.checksum_size]
-        return f'@{checksum!s}'
+    def _get_checksums(self, rows, version=None):
+        """
+        Get the checksums of a block of rows.
+
+        Version 1 is md5(columns + secret). Version 2 is a blake2b keyed with the
+        secret, whose initial state is computed once and copied for each row.
+        """
+        columns = self.checksum_columns
+        size = self.checksum_size
+        checksums = []
+        if (version or self.checksum_version) == 2:
+            keyed_hash = _get_keyed_hash(self.secret)
+            for row in rows:
+                to_check = KEYED_CHECKSUM_SEPARATOR.join(['' if row[key] is None else str(row[key]) for key in columns])
+                row_hash = keyed_hash.copy()
+                row_hash.update(to_check.encode('utf8'))
+                checksums.append(KEYED_CHECKSUM_PREFIX + row_hash.hexdigest()[:size])
+            return checksums
+        secret = self.secret.encode('utf8')
+        md5 = hashlib.md5
+        for row in rows:
+            to_check = ''.join(['' if row[key] is None else str(row[key]) for key in columns])
+            checksums.append('@' + md5(to_check.encode('utf8') + secret).hexdigest()[:size])
+        return checksums
 
     def preprocess_export_row(self, row):
         """
@@ -49,11 +137,42 @@ class ChecksumMixin:
         """
         row[self.checksum_fieldname] = self._get_checksum(row)
 
+    def preprocess_export_rows(self, rows):
+        """
+        Set the checksum column in a block of rows.
+        """
+        if type(self).preprocess_export_row is not ChecksumMixin.preprocess_export_row:
+            # a subclass customizes each row, so don't skip it
+            super().preprocess_export_rows(rows)
+            return
+        fieldname = self.checksum_fieldname
+        for row, checksum in zip(rows, self._get_checksums(rows)):
+            row[fieldname] = checksum
+
+    def get_read_columns(self):
+        """
+        Also read the checksum columns.
+        """
+        read_columns = super().get_read_columns()
+        read_columns.extend(
+            name for name in self.checksum_columns + [self.checksum_fieldname] if name not in read_columns
+        )
+        return read_columns
+
+    def get_export_fields(self, columns):
+        """
+        Also select the checksum columns.
+        """
+        fields = super().get_export_fields(columns)
+        return fields + [name for name in self.checksum_columns if name not in fields]
+
     def validate_row(self, row):
         """
         Verifies that the calculated checksum matches the stored checksum.
         """
-        if self._get_checksum(row) != row[self.checksum_fieldname]:
+        checksum = row[self.checksum_fieldname]
+        version = 2 if checksum and checksum.startswith(KEYED_CHECKSUM_PREFIX) else 1
+        if self._get_checksum(row, version) != checksum:
             raise ValidationError(
                 _("Checksum mismatch. Required columns cannot be edited: {}").format(
                     ','.join(self.checksum_columns)
@@ -61,16 +180,82 @@ class ChecksumMixin:
             )
 
 
-@shared_task(bind=True, base=LoggedTask)
+@contextmanager
+def _commit_lock(task, operation_id):
+    """
+    Hold the commit lock of the operation while the task commits it.
+
+    If another task holds it, because the broker redelivered a task that is still
+    running, or whose worker was lost before the lock expired, the task is retried
+    after COMMIT_LOCK_RETRY_DELAY seconds.
+    """
+    key = COMMIT_LOCK_KEY.format(operation_id)
+    token = uuid.uuid4().hex
+    if not cache.add(key, token, COMMIT_LOCK_TIMEOUT):
+        log.warning('Operation %s is already being committed, retrying the task', operation_id)
+        raise task.retry(countdown=COMMIT_LOCK_RETRY_DELAY, max_retries=None)
+    try:
+        yield
+    finally:
+        if cache.get(key) == token:
+            cache.delete(key)
+
+
+@shared_task(bind=True, base=LoggedTask, acks_late=True)
 @set_code_owner_attribute
-def do_deferred_commit(self, operation_id):  # pylint: disable=unused-argument
+def do_deferred_commit(self, operation_id):
     """
     Commit the CSV Operation, asynchronously.
+
+    The task is acknowledged when it finishes, so it runs again if the worker
+    is lost, resuming from the last checkpoint of the commit. A copy delivered
+    while the task is still running waits for it, and a copy delivered after
+    the commit was saved returns the saved status.
+    """
+    with _commit_lock(self, operation_id):
+        committed_id = CSVCommitCheckpoint.get_committed_operation_id(operation_id)
+        if committed_id:
+            log.info('Operation %s was already committed by %s', operation_id, committed_id)
+            return DeferrableMixin.load(committed_id, load_subclasses=True).status()
+        instance = DeferrableMixin.load(operation_id, load_subclasses=True)
+        instance.commit(running_task=self, operation_id=operation_id)
+        status = instance.status()
+        log.info('Commit succeeded %s %s', instance, status)
+        operation = instance.save_committed(operation_id)
+    log.info('Saved CSV state %s %s', instance, operation.data.name)
+    return status
+
+
+@shared_task(bind=True, base=LoggedTask, acks_late=True)
+@set_code_owner_attribute
+def do_deferred_commit_shard(self, operation_id):
+    """
+    Commit one shard of a CSV Operation, asynchronously.
+    Returns the id of the operation holding the committed shard state.
+    """
+    with _commit_lock(self, operation_id):
+        committed_id = CSVCommitCheckpoint.get_committed_operation_id(operation_id)
+        if committed_id:
+            log.info('CSV shard %s was already committed by %s', operation_id, committed_id)
+            return committed_id
+        instance = DeferrableMixin.load(operation_id, load_subclasses=True)
+        instance.commit_shard(running_task=self, operation_id=operation_id)
+        operation = instance.save_committed(operation_id, 'shard_commit')
+    log.info('Committed CSV shard %s %s', instance, operation.data.name)
+    return operation.id
+
+
+@shared_task(bind=True, base=LoggedTask)
+@set_code_owner_attribute
+def do_merge_commit_shards(self, shard_operation_ids, operation_id):  # pylint: disable=unused-argument
+    """
+    Merge the committed shards into the CSV Operation they were split from.
     """
     instance = DeferrableMixin.load(operation_id, load_subclasses=True)
-    instance.commit(running_task=True)
+    shards = [DeferrableMixin.load(shard_id, load_subclasses=True) for shard_id in shard_operation_ids]
+    instance.merge_shards(shards)
     status = instance.status()
-    log.info('Commit succeeded %s %s', instance, status)
+    log.info('Sharded commit succeeded %s %s', instance, status)
     operation = instance.save()
     log.info('Saved CSV state %s %s', instance, operation.data.name)
     return status
@@ -90,6 +275,16 @@ class DeferrableMixin:
     # run the task asynchonously. Otherwise, commit immediately.
     # 0 means: always run in a celery task
     size_to_defer = 0
+    # split deferred commits into this many celery tasks, which run in parallel
+    commit_shards = 0
+    # codec for the saved state, see state_codecs.STATE_CODECS
+    state_codec = 'json'
+    # save a checkpoint of deferred commits every this many rows, so retried tasks resume from it
+    # 0 means: don't save checkpoints
+    checkpoint_interval = 1000
+    # save the staged rows and results as content-addressed CSVPayloads, which
+    # are written once and shared by the operations saving the same rows
+    split_payload = False
 
     def get_unique_path(self):
         raise NotImplementedError()
@@ -101,16 +296,33 @@ class DeferrableMixin:
         Clients may pass an optional ``operating_user`` kwarg to
         indicate the ``auth.User`` who is saving this operation state.
         Otherwise, the current request's (if any) user will be recorded.
+
+        If split_payload is set, the staged rows and results are saved as
+        CSVPayloads, and only stored if no operation saved the same rows before.
+
+        Failed results are saved with the position of their message in
+        error_messages instead of the message, and load() puts it back.
         """
         state = self.__dict__.copy()
         for k in list(state):
             v = state[k]
             if k.startswith('_'):
                 del state[k]
-            elif isinstance(v, set):
+            elif isinstance(v, (set, deque)):
                 state[k] = list(v)
 
         state['__class__'] = (self.__class__.__module__, self.__class__.__name__)
+        if state.get('result_data') and state.get('error_messages'):
+            state['result_data'] = _index_result_errors(state['result_data'], state['error_messages'])
+
+        payloads = {}
+        if self.split_payload:
+            for key in PAYLOAD_KEYS:
+                if key in state:
+                    payloads[key] = CSVPayload.store(encode_state(state.pop(key), self.state_codec))
+            state['__payloads__'] = {key: payload.key for key, payload in payloads.items()}
+        if state.get('upload_key'):
+            payloads['upload'] = CSVPayload.objects.get(key=state['upload_key'])
 
         if not operation_name:
             operation_name = 'stage' if self.can_commit else 'commit'
@@ -119,9 +331,15 @@ class DeferrableMixin:
             self,
             self.get_unique_path(),
             operation_name,
-            json.dumps(state),
+            encode_state(state, self.state_codec),
             original_filename=state.get('filename', ''),
             user=operating_user or get_current_user(),
+            summary={
+                'total_rows': self.total_rows,
+                'processed_rows': self.processed_rows,
+                'saved_rows': self.saved_rows,
+            },
+            payloads=payloads.values(),
         )
         return operation
 
@@ -132,7 +350,14 @@ class DeferrableMixin:
         """
         operation = CSVOperation.objects.get(pk=operation_id)
         log.info('Loading CSV state %s', operation.data.name)
-        state = json.load(operation.data)
+        state = decode_state(operation.read_data())
+        payload_keys = state.pop('__payloads__', None)
+        if payload_keys:
+            payloads = {payload.key: payload for payload in operation.payloads.all()}
+            for key, payload_key in payload_keys.items():
+                state[key] = decode_state(payloads[payload_key].read_data())
+        if state.get('result_data') and state.get('error_messages'):
+            _restore_result_errors(state['result_data'], state['error_messages'])
         module_name, classname = state.pop('__class__')
         if classname != cls.__name__:
             if not load_subclasses:
@@ -157,25 +382,64 @@ class DeferrableMixin:
         status['result_id'] = getattr(self, 'result_id', None)
         status['saved_error_id'] = getattr(self, 'saved_error_id', None)
         status['waiting'] = bool(status['result_id'])
+        shard_task_ids = getattr(self, 'shard_task_ids', None)
+        if shard_task_ids and status['waiting']:
+            status['shards'] = {
+                'total': len(shard_task_ids),
+                'completed': sum(AsyncResult(task_id).ready() for task_id in shard_task_ids),
+            }
+            status['progress'] = self.get_progress(*shard_task_ids)
+        elif status['waiting']:
+            status['progress'] = self.get_progress(status['result_id'])
         status.update(getattr(self, '_status', {}))
         return status
 
+    def store_upload(self, upload):
+        """
+        Keep the contents of the uploaded file as a CSVPayload, referenced by the saved operations.
+        """
+        super().store_upload(upload)
+        self.upload_key = CSVPayload.store_file(upload).key
+
+    def get_upload(self):
+        """
+        Return a binary file object reading the uploaded file, from storage after load().
+        """
+        upload = super().get_upload()
+        if upload is None and getattr(self, 'upload_key', None):
+            upload = CSVPayload.objects.get(key=self.upload_key).open_data()
+        return upload
+
     def preprocess_file(self, reader):
         super().preprocess_file(reader)
         if self.error_messages:
             operation = self.save('error')
             self.saved_error_id = operation.id
 
-    def commit(self, running_task=None):
+    def stream_file(self, reader):
+        """
+        Stream the file synchronously, then record the result.
+        """
+        super().stream_file(reader)
+        operation = self.save()
+        if self.error_messages:
+            self.saved_error_id = operation.id
+
+    def commit(self, running_task=None, operation_id=None):
         """
         Automatically defer the commit to a celery task
         if the number of rows is greater than self.size_to_defer
+
+        Tasks pass the id of the operation they commit, to save checkpoints of it.
         """
         if running_task or len(self.stage) <= self.size_to_defer:
             # Either an async task is already in process,
             # or the size of the request is small enough to commit synchronously
-            self.save()
-            super().commit()
+            self._running_task = running_task
+            if not (operation_id and CSVCommitCheckpoint.objects.filter(operation_id=operation_id).exists()):
+                # a resumed commit saved its state when it first ran
+                self.save()
+            self._commit_with_checkpoints(operation_id)
         else:
             # We'll enqueue an async celery task.
             try:
@@ -191,13 +455,168 @@ class DeferrableMixin:
                 raise
 
             # Now enqueue the async task.
-            result = do_deferred_commit.delay(operation.id)
+            if self.commit_shards > 1 and len(self.stage) > 1:
+                result = self._enqueue_shards(operation)
+            else:
+                result = do_deferred_commit.delay(operation.id)
             if not result.ready():
                 self.result_id = result.id
                 log.info('Queued task %s %r', operation.id, result)
             else:
                 self._status = result.get()
 
+    def _enqueue_shards(self, operation):
+        """
+        Split the stage into commit_shards operations and commit them as a celery chord.
+        Returns the result of the task that merges the shards back into the operation.
+        """
+        stage = list(self.stage)
+        shard_size = -(-len(stage) // self.commit_shards)
+        state = self.__dict__.copy()
+        state.update(result_data=[], rollback_rows=[], error_messages={}, result_id=None)
+        try:
+            with transaction.atomic():
+                shard_ids = []
+                for start in range(0, len(stage), shard_size):
+                    state['stage'] = stage[start:start + shard_size]
+                    shard_ids.append(self.__class__(**state).save('shard').id)
+        except DatabaseError:
+            log.exception("Error saving DeferrableMixin shards: %s", self)
+            raise
+
+        shard_tasks = [do_deferred_commit_shard.s(shard_id).set(task_id=str(uuid.uuid4())) for shard_id in shard_ids]
+        self.shard_task_ids = [task.id for task in shard_tasks]
+        log.info('Queued %d shard tasks for %s', len(shard_tasks), operation.id)
+        return chord(shard_tasks)(do_merge_commit_shards.s(operation.id))
+
+    def commit_shard(self, running_task=None, operation_id=None):
+        """
+        Commit the rows of a shard created by _enqueue_shards.
+        """
+        self._running_task = running_task
+        self._commit_with_checkpoints(operation_id)
+
+    def _commit_with_checkpoints(self, operation_id):
+        """
+        Commit the stage, resuming from the checkpoints of the operation, if any.
+        Checkpoints are saved while committing, the last one after the last row,
+        and replaced by save_committed().
+        """
+        if not (operation_id and self.checkpoint_interval):
+            super().commit()
+            return
+        self._checkpoint_operation_id = operation_id
+        checkpoints = CSVCommitCheckpoint.objects.filter(operation_id=operation_id, committed_operation__isnull=True)
+        resumed = self._resume_from_checkpoints(checkpoints)
+        try:
+            super().commit()
+        finally:
+            self._checkpoint_operation_id = None
+        self.saved_rows += resumed
+
+    def save_committed(self, operation_id, operation_name=None):
+        """
+        Save the state of the commit of operation_id, and mark the operation
+        committed, in one transaction. Returns the saved operation.
+        """
+        with transaction.atomic():
+            operation = self.save(operation_name)
+            CSVCommitCheckpoint.mark_committed(operation_id, operation)
+        return operation
+
+    def _resume_from_checkpoints(self, checkpoints):
+        """
+        Skip the staged rows committed before the last checkpoint, restoring
+        their rollback rows and errors. Returns the number of rows they saved.
+        """
+        self._checkpoint_row = self._checkpoint_saved = self._checkpoint_rollback_rows = 0
+        last = None
+        for last in checkpoints.order_by('last_row'):
+            state = decode_state(last.read_data())
+            self.rollback_rows.extend(tuple(item) for item in state['rollback_rows'])
+        if last is None:
+            return 0
+        self._add_commit_errors({
+            message: RowRanges.from_saved(rows) for message, rows in state['error_messages'].items()
+        })
+        while self.stage and self.stage[0][0] <= last.last_row:
+            self.stage.popleft()
+        self._checkpoint_row = last.last_row
+        self._checkpoint_saved = last.saved_rows
+        self._checkpoint_rollback_rows = len(self.rollback_rows)
+        log.info('Resuming commit of operation %s after row %d', self._checkpoint_operation_id, last.last_row)
+        return last.saved_rows
+
+    def checkpoint(self, rownum, saved):
+        """
+        Save a checkpoint of the commit every checkpoint_interval rows, and after the last row.
+        The checkpoint holds the rollback rows added since the previous one.
+        """
+        operation_id = getattr(self, '_checkpoint_operation_id', None)
+        if not operation_id or (self.stage and rownum - self._checkpoint_row < self.checkpoint_interval):
+            return
+        new_rows = len(self.rollback_rows) - self._checkpoint_rollback_rows
+        rollback_rows = list(islice(reversed(self.rollback_rows), new_rows))[::-1]
+        state = {'rollback_rows': rollback_rows, 'error_messages': self.error_messages}
+        CSVCommitCheckpoint.record(
+            operation_id, rownum, self._checkpoint_saved + saved, encode_state(state, self.state_codec)
+        )
+        self._checkpoint_row = rownum
+        self._checkpoint_rollback_rows = len(self.rollback_rows)
+        cache.touch(COMMIT_LOCK_KEY.format(operation_id), COMMIT_LOCK_TIMEOUT)
+
+    def report_progress(self, progress):
+        """
+        Publish commit progress as the state of the running celery task.
+        """
+        task = getattr(self, '_running_task', None)
+        request = getattr(task, 'request', None)
+        if request is not None and request.id and not request.is_eager:
+            task.update_state(state=PROGRESS_STATE, meta=progress)
+
+    @classmethod
+    def get_progress(cls, *result_ids):
+        """
+        Return the commit progress published by the given celery tasks, added up.
+        Returns None if none of them has published progress.
+
+        Only reads the task state from the result backend, never the saved CSV state.
+        """
+        total = {}
+        for result_id in result_ids:
+            result = AsyncResult(result_id)
+            if result.state != PROGRESS_STATE or not isinstance(result.info, dict):
+                continue
+            for key, value in result.info.items():
+                if key in total and (total[key] is None or value is None):
+                    total[key] = None
+                else:
+                    total[key] = total.get(key, 0) + value
+        return total or None
+
+    def merge_shards(self, shards):
+        """
+        Merge the results of committed shards into this processor.
+        """
+        self.stage.clear()
+        self.saved_rows = 0
+        for shard in shards:
+            self.saved_rows += shard.saved_rows
+            self.rollback_rows.extend(shard.rollback_rows)
+            self._add_commit_errors(shard.error_messages)
+
+    def _add_commit_errors(self, error_messages):
+        """
+        Add errors of committed rows, marking their results as failed.
+        """
+        for message, rows in error_messages.items():
+            for rownum in rows:
+                message = self.add_error(message, rownum)
+                result = self._get_result(rownum)
+                if result is not None:
+                    result['error'] = message
+                    result['status'] = _('Failure')
+
     def get_committed_history(self):
         """
         Get the history of all committed CSV upload operations.
@@ -208,3 +627,21 @@ class DeferrableMixin:
         committed_history = all_history.filter(operation='commit')
         history_with_users = CSVOperationSerializer.get_related_queryset(committed_history).order_by('-created')
         return CSVOperationSerializer(history_with_users, many=True).data
+
+    def get_committed_history_page(self, page_size=20, cursor=None):
+        """
+        Get a page of the history of committed CSV upload operations, newest first.
+
+        Pass the returned next_cursor to get the following page.
+        Returns a dictionary with results (a list of dictionaries) and next_cursor (None on the last page).
+        """
+        history = CSVOperation.get_history_page(self, self.get_unique_path(), 'commit', cursor)
+        page = list(CSVOperationSerializer.get_related_queryset(history)[:page_size + 1])
+        next_cursor = None
+        if len(page) > page_size:
+            page = page[:page_size]
+            next_cursor = page[-1].get_history_cursor()
+        return {
+            'results': CSVOperationSerializer(page, many=True).data,
+            'next_cursor': next_cursor,
+        }
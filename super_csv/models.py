@@ -2,23 +2,132 @@
 Database models for super_csv.
 """
 
+import hashlib
 import logging
+import tempfile
 import uuid
-from datetime import timedelta
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import partial
 
 from django.contrib.auth import get_user_model
-from django.core.files.base import ContentFile
-from django.db import models
+from django.core.cache import cache
+from django.core.files.base import ContentFile, File
+from django.db import IntegrityError, models, transaction
 from django.utils.timezone import now
 from model_utils.models import TimeStampedModel
 
+from .compression import compress, compress_file, decompress, open_decompressed
+
 log = logging.getLogger(__name__)
 
+EXPIRE_BATCH_SIZE = 500
+EXPIRE_DELETE_WORKERS = 8
+EXPIRE_LOCK_KEY = 'super_csv.expire_data.lock'
+EXPIRE_LOCK_TIMEOUT = 60 * 60
+# payload files are hashed and compressed in blocks of this size, and spooled to disk above it
+PAYLOAD_BLOCK_SIZE = 1024 * 1024
+
 
 def csv_class_path(instance, filename):
     return f'csv/{instance.class_name}/{instance.unique_id}/{filename}'
 
 
+def csv_payload_path(instance, filename):  # pylint: disable=unused-argument
+    return f'csv/payloads/{instance.key[:2]}/{instance.key}'
+
+
+class CSVPayload(models.Model):
+    """
+    Row data of saved processor states, stored once per content and shared by operations.
+
+    .. no_pii:
+    """
+    # sha256 of the uncompressed data
+    key = models.CharField(max_length=64, unique=True)
+    data = models.FileField(upload_to=csv_payload_path, max_length=255)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        app_label = "super_csv"
+
+    @classmethod
+    def store(cls, data):
+        """
+        Return the payload holding the data (bytes), storing it if it isn't stored yet.
+        """
+        key = hashlib.sha256(data).hexdigest()
+        payload = cls._reuse(key)
+        if payload is not None:
+            return payload
+        return cls._create(key, ContentFile(compress(data)))
+
+    @classmethod
+    def store_file(cls, fileobj):
+        """
+        Return the payload holding the contents of the binary file object,
+        storing them if they aren't stored yet. The file is read a block at a time.
+        """
+        digest = hashlib.sha256()
+        for block in iter(partial(fileobj.read, PAYLOAD_BLOCK_SIZE), b''):
+            digest.update(block)
+        key = digest.hexdigest()
+        payload = cls._reuse(key)
+        if payload is not None:
+            return payload
+        fileobj.seek(0)
+        with tempfile.SpooledTemporaryFile(max_size=PAYLOAD_BLOCK_SIZE) as compressed:
+            compress_file(fileobj, compressed)
+            compressed.seek(0)
+            return cls._create(key, File(compressed))
+
+    @classmethod
+    def _reuse(cls, key):
+        """
+        Return the stored payload for the key, or None.
+
+        Its created time is refreshed, so expire_data() treats it as new
+        until the operation reusing it references it.
+        """
+        if not cls.objects.filter(key=key).update(created=now()):
+            # not stored, or just deleted by expire_data()
+            return None
+        return cls.objects.get(key=key)
+
+    @classmethod
+    def _create(cls, key, content):
+        """
+        Save the compressed content as the payload for the key.
+        """
+        instance = cls(key=key)
+        instance.data.save(key, content, save=False)
+        try:
+            with transaction.atomic():
+                instance.save()
+        except IntegrityError:
+            # stored concurrently by another save
+            instance.data.delete(save=False)
+            return cls.objects.get(key=key)
+        return instance
+
+    def read_data(self):
+        """
+        Return the stored data, decompressed, as bytes.
+        """
+        with self.data.open('rb') as data:
+            return decompress(data.read())
+
+    def open_data(self):
+        """
+        Open the stored data for reading, decompressed, as a binary file object.
+        """
+        return open_decompressed(self.data.open('rb'))
+
+    def __str__(self):
+        return f'Payload {self.key}'
+
+
 class CSVOperation(TimeStampedModel):
     """
     Store processing operations/results.
@@ -31,9 +140,21 @@ class CSVOperation(TimeStampedModel):
     original_filename = models.CharField(max_length=255, blank=True, default='')
     user = models.ForeignKey(get_user_model(), null=True, on_delete=models.SET_NULL)
     data = models.FileField(upload_to=csv_class_path, max_length=255)
+    # summary counters of the saved state, so history can be listed without reading data
+    total_rows = models.PositiveIntegerField(null=True, blank=True)
+    processed_rows = models.PositiveIntegerField(null=True, blank=True)
+    saved_rows = models.PositiveIntegerField(null=True, blank=True)
+    # row data saved separately from the state, see DeferrableMixin.split_payload
+    payloads = models.ManyToManyField(CSVPayload, blank=True, related_name='operations')
+    # set once expire_data() deleted the stored data
+    expired = models.BooleanField(default=False)
 
     class Meta:
         app_label = "super_csv"
+        indexes = [
+            models.Index(fields=['class_name', 'unique_id', 'operation', 'created'], name='super_csv_history_idx'),
+            models.Index(fields=['expired', 'modified'], name='super_csv_expiry_idx'),
+        ]
 
     @classmethod
     def _get_class_name(cls, obj):
@@ -47,6 +168,37 @@ class CSVOperation(TimeStampedModel):
             class_name=cls._get_class_name(class_name_or_obj),
             unique_id=unique_id)
 
+    @classmethod
+    def get_history_page(cls, class_name_or_obj, unique_id, operation, cursor=None):
+        """
+        Get the operations of one kind, newest first, starting after the cursor.
+
+        cursor is a token from get_history_cursor() for the last operation of the previous page.
+        Slice the returned queryset to get a page.
+        """
+        history = cls.get_all_history(class_name_or_obj, unique_id).filter(operation=operation)
+        if cursor:
+            created, pk = cls._decode_cursor(cursor)
+            history = history.filter(models.Q(created__lt=created) | models.Q(created=created, pk__lt=pk))
+        return history.order_by('-created', '-pk')
+
+    def get_history_cursor(self):
+        """
+        Get the continuation token for the history page ending with this operation.
+        """
+        return urlsafe_b64encode(f'{self.created.isoformat()}|{self.pk}'.encode()).decode()
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        """
+        Decode a history cursor. Raises ValueError if it is invalid.
+        """
+        try:
+            created, pk = urlsafe_b64decode(cursor.encode()).decode().split('|')
+            return datetime.fromisoformat(created), int(pk)
+        except (TypeError, ValueError) as exc:
+            raise ValueError(f'Invalid history cursor: {cursor!r}') from exc
+
     @classmethod
     def get_latest(cls, class_name_or_obj, unique_id):
         """
@@ -59,9 +211,13 @@ class CSVOperation(TimeStampedModel):
 
     # pylint: disable=too-many-positional-arguments
     @classmethod
-    def record_operation(cls, class_name_or_obj, unique_id, operation, data, original_filename='', user=None):
+    def record_operation(cls, class_name_or_obj, unique_id, operation, data, original_filename='', user=None,
+                         summary=None, payloads=()):
         """
         Save a CSVOperation
+
+        summary is an optional dict of the total_rows, processed_rows and saved_rows counters.
+        payloads are the CSVPayloads referenced by the data.
         """
         instance = cls(
             class_name=cls._get_class_name(class_name_or_obj),
@@ -69,20 +225,101 @@ class CSVOperation(TimeStampedModel):
             operation=operation,
             original_filename=original_filename,
             user=user,
+            **(summary or {}),
         )
-        instance.data.save(uuid.uuid4(), ContentFile(data.encode()))
+        if isinstance(data, str):
+            data = data.encode()
+        instance.data.save(uuid.uuid4(), ContentFile(compress(data)), save=False)
+        # link the payloads in the same transaction, so expire_data() never sees the operation without them
+        with transaction.atomic():
+            instance.save()
+            if payloads:
+                instance.payloads.add(*payloads)
         return instance
 
+    def read_data(self):
+        """
+        Return the stored data, decompressed, as bytes.
+        """
+        with self.data.open('rb') as data:
+            return decompress(data.read())
+
     @classmethod
-    def expire_data(cls, expiration_days):
+    def expire_data(cls, expiration_days, batch_size=EXPIRE_BATCH_SIZE):
         """
         Delete data older than expiration_time (days)
+
+        Expired operations are handled in batches of batch_size, ordered by id.
+        The stored files of each batch are deleted concurrently, then the operations
+        are marked expired and their data field cleared. Operations are found through
+        the index on (expired, modified), so expired ones are not scanned again.
+        Expired payloads no longer referenced by any operation are deleted at the end.
+        Only one expiration runs at a time; others return immediately. If the lock
+        times out, the run that took it over keeps it when this one finishes.
+        Returns the number of expired operations.
         """
-        if expiration_days:
+        if not expiration_days:
+            return 0
+        token = uuid.uuid4().hex
+        if not cache.add(EXPIRE_LOCK_KEY, token, EXPIRE_LOCK_TIMEOUT):
+            log.info('CSV data expiration is already running')
+            return 0
+        try:
             expiration = now() - timedelta(days=expiration_days)
-            for obj in cls.objects.filter(modified__lte=expiration):
-                log.info('Expiring %r', obj.data)
-                obj.data.delete()
+            expired = cls.objects.filter(expired=False, modified__lte=expiration).order_by('pk')
+            storage = cls._meta.get_field('data').storage
+            total = last_pk = 0
+            with ThreadPoolExecutor(EXPIRE_DELETE_WORKERS) as executor:
+                while True:
+                    batch = list(expired.filter(pk__gt=last_pk).values_list('pk', 'data')[:batch_size])
+                    if not batch:
+                        break
+                    pks, names = zip(*batch)
+                    last_pk = pks[-1]
+                    gone = executor.map(partial(cls._delete_stored_file, storage), names)
+                    deleted = [pk for pk, did_delete in zip(pks, gone) if did_delete]
+                    cls.payloads.through.objects.filter(csvoperation_id__in=deleted).delete()
+                    total += cls.objects.filter(pk__in=deleted).update(data='', expired=True)
+                cls._delete_unreferenced_payloads(executor, storage, expiration, batch_size)
+            return total
+        finally:
+            if cache.get(EXPIRE_LOCK_KEY) == token:
+                cache.delete(EXPIRE_LOCK_KEY)
+
+    @classmethod
+    def _delete_unreferenced_payloads(cls, executor, storage, expiration, batch_size):
+        """
+        Delete the payloads created before expiration that no operation references,
+        in batches of batch_size. Newer payloads may be about to be referenced.
+
+        The rows are deleted first, checking again that they are unreferenced and
+        expired, then the files of the deleted rows.
+        """
+        unreferenced = CSVPayload.objects.filter(operations=None, created__lte=expiration).order_by('pk')
+        last_pk = 0
+        while True:
+            batch = list(unreferenced.filter(pk__gt=last_pk).values_list('pk', 'data')[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+            pks = [pk for pk, __ in batch]
+            unreferenced.filter(pk__in=pks).delete()
+            kept = set(CSVPayload.objects.filter(pk__in=pks).values_list('pk', flat=True))
+            names = [name for pk, name in batch if pk not in kept]
+            list(executor.map(partial(cls._delete_stored_file, storage), names))
+
+    @staticmethod
+    def _delete_stored_file(storage, name):
+        """
+        Delete a stored file. Returns whether it is gone.
+        """
+        log.info('Expiring %s', name)
+        try:
+            storage.delete(name)
+        except Exception:  # pylint: disable=broad-exception-caught
+            log.exception('Failed to expire %s', name)
+            return False
+        return True
 
     def __str__(self):
         return f'Operation for {self.class_name} {self.unique_id}'
@@ -90,3 +327,77 @@ class CSVOperation(TimeStampedModel):
     def delete(self, *args):
         self.data.delete()
         super().delete(*args)
+
+
+class CSVCommitCheckpoint(models.Model):
+    """
+    Progress of a deferred commit, saved periodically so a retried task can resume it.
+
+    Each checkpoint holds the rollback rows of the rows committed since the
+    previous checkpoint, and the commit errors so far. Once the commit is saved,
+    its checkpoints are replaced with one pointing at the committed operation,
+    so a task delivered again doesn't commit the rows twice.
+
+    .. no_pii:
+    """
+    operation = models.ForeignKey(CSVOperation, on_delete=models.CASCADE, related_name='checkpoints')
+    # number of the last committed row
+    last_row = models.PositiveIntegerField()
+    # number of rows saved up to last_row
+    saved_rows = models.PositiveIntegerField()
+    # compressed state, see DeferrableMixin.checkpoint()
+    data = models.BinaryField()
+    created = models.DateTimeField(auto_now_add=True)
+    # the operation saving the finished commit, see mark_committed()
+    committed_operation = models.ForeignKey(CSVOperation, null=True, on_delete=models.CASCADE, related_name='+')
+
+    class Meta:
+        app_label = "super_csv"
+        ordering = ['operation', 'last_row']
+
+    @classmethod
+    def record(cls, operation_id, last_row, saved_rows, data):
+        """
+        Save a checkpoint of the data (bytes) for the operation.
+        """
+        return cls.objects.create(
+            operation_id=operation_id,
+            last_row=last_row,
+            saved_rows=saved_rows,
+            data=compress(data),
+        )
+
+    @classmethod
+    def mark_committed(cls, operation_id, committed_operation):
+        """
+        Replace the checkpoints of the operation with one marking it committed,
+        whose state committed_operation saved.
+        """
+        checkpoints = cls.objects.filter(operation_id=operation_id)
+        last = checkpoints.order_by('-last_row').first()
+        checkpoints.delete()
+        return cls.objects.create(
+            operation_id=operation_id,
+            last_row=last.last_row if last else 0,
+            saved_rows=committed_operation.saved_rows,
+            data=b'',
+            committed_operation=committed_operation,
+        )
+
+    @classmethod
+    def get_committed_operation_id(cls, operation_id):
+        """
+        Return the id of the operation that saved the commit of the operation, or None.
+        """
+        return cls.objects.filter(
+            operation_id=operation_id, committed_operation__isnull=False
+        ).values_list('committed_operation_id', flat=True).first()
+
+    def read_data(self):
+        """
+        Return the checkpoint data, decompressed, as bytes.
+        """
+        return decompress(bytes(self.data))
+
+    def __str__(self):
+        return f'Checkpoint of operation {self.operation_id} at row {self.last_row}'
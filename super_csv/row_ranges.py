@@ -0,0 +1,67 @@
+"""
+Compact storage for lists of row numbers.
+"""
+
+
+class RowRanges:
+    """
+    A list of row numbers stored as [start, end] ranges of consecutive rows.
+
+    Behaves like the list of row numbers it replaces: appends keep their order,
+    and iterating yields every row number. Runs of failing rows, which are the
+    common case, take one range each instead of one entry per row.
+    """
+    __slots__ = ('ranges', '_count')
+
+    def __init__(self, rows=()):
+        self.ranges = []
+        self._count = 0
+        for rownum in rows:
+            self.append(rownum)
+
+    @classmethod
+    def from_saved(cls, saved):
+        """
+        Load saved ranges, or a plain list of row numbers saved by older versions.
+        """
+        if isinstance(saved, RowRanges):
+            return saved
+        instance = cls()
+        for item in saved:
+            if isinstance(item, (list, tuple)):
+                start, end = item
+                instance.ranges.append([start, end])
+                instance._count += end - start + 1
+            else:
+                instance.append(item)
+        return instance
+
+    def append(self, rownum):
+        """
+        Add a row number.
+        """
+        if self.ranges and self.ranges[-1][1] + 1 == rownum:
+            self.ranges[-1][1] = rownum
+        else:
+            self.ranges.append([rownum, rownum])
+        self._count += 1
+
+    def __iter__(self):
+        for start, end in self.ranges:
+            yield from range(start, end + 1)
+
+    def __len__(self):
+        return self._count
+
+    def __bool__(self):
+        return bool(self._count)
+
+    def __eq__(self, other):
+        if isinstance(other, RowRanges):
+            return self.ranges == other.ranges
+        if isinstance(other, (list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.ranges!r})'
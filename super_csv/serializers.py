@@ -4,12 +4,12 @@ Serializers for CSV operation data.
 
 import logging
 
-import simplejson as json
 from django.contrib.auth import get_user_model
 from django.utils.translation import gettext as _
 from rest_framework import serializers
 
 from .models import CSVOperation
+from .state_codecs import decode_state
 
 logger = logging.getLogger(__name__)
 
@@ -46,10 +46,14 @@ class CSVOperationSerializer(serializers.ModelSerializer):
     def get_data(self, operation):
         """
         Get data
+
+        Uses the summary counters stored on the operation, if any, instead of reading the saved state.
         """
+        if operation.total_rows is not None:
+            return CSVOperationDataSerializer(operation).data
         data = None
         try:
-            data = json.load(operation.data)
+            data = decode_state(operation.read_data())
         except (FileNotFoundError, ValueError):
             msg = _('Failed to retrieve file.')
 
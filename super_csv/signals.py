@@ -2,6 +2,7 @@
 Signals for super_csv
 """
 
+from django.db import transaction
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 
@@ -16,5 +17,6 @@ def expire_on_save(sender, instance, **kwargs):  # pylint: disable=unused-argume
     """
     # to slightly reduce impact, we'll do the expiration check
     # every third operation
+    # once committed, so the operation is saved with its payloads
     if instance.pk % 3 == 0:
-        expire_data.apply_async()
+        transaction.on_commit(expire_data.apply_async)
@@ -0,0 +1,104 @@
+"""
+Codecs for the processor state saved by DeferrableMixin.
+
+JSON state is stored as-is, so operations saved before codecs existed still load.
+Other codecs prefix the data with a short header naming the codec.
+"""
+
+from collections.abc import Mapping
+
+import simplejson as json
+from django.core.exceptions import ImproperlyConfigured
+
+from .exceptions import StateCodecError
+from .row_ranges import RowRanges
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+HEADER_PREFIX = b'SCSV:'
+
+
+def _to_serializable(obj):
+    """
+    Serialize dict-like objects, such as compact rows, as dicts,
+    and row number ranges as lists of [start, end] pairs.
+    """
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    if isinstance(obj, RowRanges):
+        return obj.ranges
+    raise TypeError(f'Object of type {obj.__class__.__name__} is not serializable')
+
+
+class JSONStateCodec:
+    """
+    Plain JSON, the original state format.
+    """
+    name = 'json'
+
+    def dumps(self, state):
+        return json.dumps(state, default=_to_serializable).encode('utf8')
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class MsgpackStateCodec:
+    """
+    Compact binary state using msgpack.
+    """
+    name = 'msgpack'
+
+    def _check_installed(self):
+        if msgpack is None:
+            raise ImproperlyConfigured('The msgpack state codec requires the msgpack package')
+
+    def dumps(self, state):
+        self._check_installed()
+        return msgpack.packb(state, use_bin_type=True, default=_to_serializable)
+
+    def loads(self, data):
+        """
+        Unpack the state, raising StateCodecError if the data isn't valid msgpack.
+        """
+        self._check_installed()
+        try:
+            return msgpack.unpackb(data, raw=False, strict_map_key=False)
+        except (msgpack.UnpackException, ValueError) as exc:
+            raise StateCodecError(str(exc)) from exc
+
+
+STATE_CODECS = {codec.name: codec for codec in (JSONStateCodec(), MsgpackStateCodec())}
+
+
+def _get_codec(name):
+    try:
+        return STATE_CODECS[name]
+    except KeyError as exc:
+        raise StateCodecError(f'Unknown state codec: {name!s}') from exc
+
+
+def encode_state(state, codec_name='json'):
+    """
+    Serialize the state dict to bytes with the named codec.
+    """
+    codec = _get_codec(codec_name)
+    data = codec.dumps(state)
+    if codec_name == 'json':
+        return data
+    return HEADER_PREFIX + codec_name.encode('ascii') + b'\n' + data
+
+
+def decode_state(data):
+    """
+    Deserialize state bytes written by encode_state, detecting the codec from the header.
+    """
+    if data.startswith(HEADER_PREFIX):
+        header, __, data = data.partition(b'\n')
+        codec = _get_codec(header[len(HEADER_PREFIX):].decode('ascii'))
+    else:
+        codec = STATE_CODECS['json']
+    return codec.loads(data)
@@ -0,0 +1,38 @@
+"""
+Entry points of the worker processes that preprocess rows for CSVProcessor.
+
+Worker processes are spawned, so this module must not import models:
+Django is set up by the worker before the processor is unpickled.
+"""
+
+import pickle
+
+import django
+from django.utils import translation
+
+_worker_processor = None
+
+
+def activate_language(language):
+    """
+    Activate the language, or deactivate translations if it is None.
+    """
+    if language:
+        translation.activate(language)
+    else:
+        translation.deactivate_all()
+
+
+def init_preprocess_worker(state, language):
+    """
+    Set up a preprocessing worker process: set Django up, activate
+    the caller's language and keep the pickled processor.
+    """
+    global _worker_processor  # pylint: disable=global-statement
+    django.setup()
+    activate_language(language)
+    _worker_processor = pickle.loads(state)
+
+
+def preprocess_in_worker(row):
+    return _worker_processor._preprocess_one(row)  # pylint: disable=protected-access
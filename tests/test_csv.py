@@ -2,16 +2,30 @@
 Tests for CSVProcessor
 """
 
+import csv
+import gzip
 import io
+import pickle
+import time
+import unittest
+from collections import deque
 from unittest import mock
 
 import ddt
+import simplejson as json
+from celery.exceptions import Retry
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 # could use BytesIO, but this adds a size attribute
 from django.core.files.base import ContentFile
-from django.test import TestCase
+from django.db import connection, connections
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import translation
+from django.utils.translation import gettext
 
-from super_csv import csv_processor, models
+from super_csv import csv_processor, mixins, models
+from super_csv.state_codecs import msgpack
 
 
 class DummyProcessor(csv_processor.CSVProcessor):
@@ -42,11 +56,67 @@ class DummyProcessor(csv_processor.CSVProcessor):
         return True, undo
 
 
+class DummyBatchProcessor(DummyProcessor):
+    """
+    Fixture class that saves rows in batches.
+    """
+    max_file_size = 0
+    commit_batch_size = 2
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.batches = []
+
+    def process_rows(self, rows):
+        self.batches.append([row['foo'] for row in rows])
+        if any(row['foo'] == '5' for row in rows):
+            raise ValueError('5 is not allowed')
+        return [ValueError('4 is not allowed') if row['foo'] == '4' else (True, None) for row in rows]
+
+
+class DummyUserProcessor(DummyProcessor):
+    """
+    Fixture class that creates a user for each row.
+    """
+    max_file_size = 0
+    commit_atomic = True
+
+    def process_row(self, row):
+        get_user_model().objects.create(username=f'row{row["foo"]}')
+        return super().process_row(row)
+
+
+class DummyTranslatedProcessor(DummyProcessor):
+    """
+    Fixture class with a translated validation error.
+    """
+    max_file_size = 0
+
+    def validate_row(self, row):
+        if row['foo'] == '3':
+            raise csv_processor.ValidationError(gettext('This field is required.'))
+
+
 class DummyChecksumProcessor(csv_processor.ChecksumMixin, DummyProcessor):
     checksum_columns = ['foo', 'bar']
     columns = ['foo', 'bar', 'csum']
 
 
+class DummyShardedProcessor(DummyChecksumProcessor):
+    """
+    Fixture class that exports in shards of user ids.
+    """
+    export_batch_size = 3
+
+    def get_export_shards(self):
+        return [(start, start + 10) for start in range(0, 50, 10)]
+
+    def get_shard_rows_to_export(self, shard):
+        # finish the first shards last
+        time.sleep((50 - shard[0]) / 5000)
+        return [{'foo': i, 'bar': f'ü{i}'} for i in range(*shard)]
+
+
 class DummyDeferrableProcessor(csv_processor.DeferrableMixin, DummyProcessor):
     size_to_defer = 1
     test_set = set()
@@ -133,6 +203,72 @@ class CSVTestCase(TestCase):
         if message:
             assert status["error_messages"][0] == message
 
+    def test_projected_reader(self):
+        contents = 'baz,foo,bar,qux\r\nx,1,"ü\nß",y\r\n\r\nx,2\r\nx,3,"a,b",y,extra'.encode('utf-8')
+        lines = list(csv_processor.decode_utf8_blocks(io.BytesIO(contents), block_size=3))
+        assert ''.join(lines) == contents.decode('utf-8')
+        reader = csv_processor.ProjectedReader(lines, ['foo', 'bar', 'missing'])
+        assert reader.fieldnames == ['baz', 'foo', 'bar', 'qux']
+        expected = [
+            {'foo': row['foo'], 'bar': row['bar']}
+            for row in csv.DictReader(io.StringIO(contents.decode('utf-8'), newline=''))
+        ]
+        assert list(reader) == expected == [
+            {'foo': '1', 'bar': 'ü\nß'}, {'foo': '2', 'bar': None}, {'foo': '3', 'bar': 'a,b'},
+        ]
+
+    def test_read_projected(self):
+        processor = DummyChecksumProcessor(projected_reader=True, max_file_size=0)
+        buf = io.StringIO()
+        processor.write_file(buf)
+        contents = buf.getvalue().replace('foo,', 'ignored,foo,', 1).replace('\r\n', '\r\nx,')[:-2]
+        processor.process_file(ContentFile(contents.encode('utf-8')))
+        status = processor.status()
+        assert status['processed'] == 2
+        assert not status['error_messages']
+        assert set(processor.result_data[0]) == {'foo', 'bar', 'csum', 'status', 'error'}
+
+    def test_read_projected_missing_column(self):
+        processor = DummyProcessor(projected_reader=True)
+        processor.process_file(ContentFile(b'foo,baz\r\n'))
+        assert processor.status()['error_messages'] == ['Missing column: bar']
+
+    def test_row(self):
+        header = csv_processor.RowHeader(['foo', 'bar'])
+        row = csv_processor.Row(header, ['1', None])
+        assert row == {'foo': '1', 'bar': None}
+        assert row['foo'] == '1' and row.get('baz') is None and 'bar' in row
+        row['baz'] = 3
+        del row['bar']
+        assert list(row.items()) == [('foo', '1'), ('baz', 3)]
+        assert len(row) == 2
+        with self.assertRaises(KeyError):
+            row['bar']  # pylint: disable=pointless-statement
+        copy = row.copy()
+        assert isinstance(copy, dict) and copy == {'foo': '1', 'baz': 3}
+        result = row.get_result()
+        assert result == {'foo': '1', 'baz': 3, 'error': '', 'status': 'Success'}
+        assert result.header is csv_processor.Row(header, ['2', '2']).get_result().header
+        result['foo'] = '2'
+        assert row['foo'] == '1'
+        # rows sent to worker processes keep deleted keys deleted
+        assert pickle.loads(pickle.dumps(row)) == {'foo': '1', 'baz': 3}
+
+    def test_read_compact_rows(self):
+        contents = b'foo,bar,baz\r\n1,1,x\r\n3,3,x\r\n4,4,x\r\n'
+        expected = DummyDeferrableProcessor(max_file_size=0, size_to_defer=10)
+        expected.process_file(ContentFile(contents), autocommit=False)
+        processor = DummyDeferrableProcessor(max_file_size=0, size_to_defer=10, compact_rows=True)
+        processor.process_file(ContentFile(contents), autocommit=False)
+        assert all(isinstance(row, csv_processor.Row) for row in processor.result_data)
+        assert all(isinstance(row, csv_processor.Row) for __, row in processor.stage)
+        assert processor.result_data == expected.result_data
+        assert list(processor.stage) == list(expected.stage)
+        assert processor.status()['error_rows'] == expected.status()['error_rows']
+        loaded = DummyDeferrableProcessor.load(processor.save().id)
+        assert loaded.result_data == expected.result_data
+        assert [tuple(item) for item in loaded.stage] == list(expected.stage)
+
     def test_write_column_overrides(self):
         # Given existing data to write
         processor = DummyProcessor()
@@ -201,6 +337,107 @@ class CSVTestCase(TestCase):
             'd,Failure,Error'
         ]
 
+    @ddt.data(False, True)
+    def test_buffered_iterator(self, error_data):
+        processor = DummyChecksumProcessor(export_batch_size=3)
+        processor.result_data = [{'foo': i, 'bar': 'ü' * i, 'status': 'Success', 'error': ''} for i in range(50)]
+        rows = None if error_data else [{'foo': i, 'bar': 'ü' * i} for i in range(50)]
+        expected = ''.join(processor.get_iterator(rows=rows, error_data=error_data)).encode('utf-8')
+        chunks = list(processor.get_buffered_iterator(rows=rows, error_data=error_data, chunk_size=100))
+        assert b''.join(chunks) == expected
+        assert len(chunks) > 1
+        assert all(len(chunk) >= 100 for chunk in chunks[:-1])
+
+    def test_buffered_iterator_gzip(self):
+        processor = DummyChecksumProcessor()
+        chunks = list(processor.get_buffered_iterator(gzip=True))
+        expected = ''.join(processor.get_iterator()).encode('utf-8')
+        assert gzip.decompress(b''.join(chunks)) == expected
+
+    @ddt.data(
+        ('gzip, deflate, br', True), ('deflate;q=1, gzip;q=0.5', True), ('br', False), ('', False),
+        ('gzip;q=0, deflate', False), ('GZIP; Q=0.0', False), ('*', True), ('gzip;q=0, *', False),
+        ('gzip;q=x', False),
+    )
+    @ddt.unpack
+    def test_accepts_gzip(self, accept_encoding, expected):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING=accept_encoding)
+        assert csv_processor.accepts_gzip(request) is expected
+
+    def test_unicode_dict_writer(self):
+        buf = io.BytesIO()
+        writer = csv_processor.UnicodeDictWriter(buf, ['foo', 'bar'], extrasaction='ignore')
+        writer.writeheader()
+        writer.writerow({'foo': 'ü,1', 'bar': None, 'baz': 'ignored'})
+        writer.writerows([{'foo': 2, 'bar': 'ß'}])
+        del writer
+        assert not buf.closed
+        assert buf.getvalue() == 'foo,bar\r\n"ü,1",\r\n2,ß\r\n'.encode('utf-8')
+
+    def test_unicode_writer_encoding(self):
+        buf = io.BytesIO()
+        csv_processor.UnicodeWriter(buf, encoding='utf-16-le').writerow(['ü', 1])
+        assert buf.getvalue() == 'ü,1\r\n'.encode('utf-16-le')
+
+    def test_export_queryset(self):
+        for name in ('a', 'b', 'c'):
+            models.CSVOperation.record_operation(name, 'course', 'commit', '{}')
+        processor = DummyChecksumProcessor(
+            columns=['class_name', 'operation', 'csum'],
+            checksum_columns=['class_name', 'unique_id'],
+            export_queryset_chunk_size=2,
+        )
+        rows = [
+            {'class_name': name, 'unique_id': 'course', 'operation': 'commit'}
+            for name in ('a', 'b', 'c')
+        ]
+        expected = list(processor.get_iterator(rows=rows))
+        with CaptureQueriesContext(connection) as queries:
+            output = list(processor.get_iterator(rows=models.CSVOperation.objects.order_by('class_name')))
+        assert output == expected
+        assert len(queries) == 1
+        select = queries[0]['sql'].split(' FROM ')[0]
+        assert '"class_name"' in select and '"unique_id"' in select
+        assert '"data"' not in select
+
+    def test_export_queryset_without_projection(self):
+        operation = models.CSVOperation.record_operation('a', 'course', 'commit', '{}')
+        processor = DummyProcessor(columns=['id', 'class_name'], export_values_projection=False)
+        output = list(processor.get_iterator(rows=models.CSVOperation.objects.all()))
+        assert output == ['id,class_name\r\n', f'{operation.id},a\r\n']
+
+    def test_sharded_export(self):
+        rows = [{'foo': i, 'bar': f'ü{i}'} for i in range(50)]
+        expected = ''.join(DummyChecksumProcessor().get_iterator(rows=rows))
+        assert ''.join(DummyShardedProcessor().get_iterator()) == expected
+        processor = DummyShardedProcessor(export_workers=2)
+        with mock.patch.object(processor, 'get_rows_to_export') as get_rows, \
+                mock.patch.object(processor, 'get_export_shards', wraps=processor.get_export_shards) as get_shards:
+            assert ''.join(processor.get_iterator()) == expected
+            assert b''.join(processor.get_buffered_iterator(chunk_size=100)) == expected.encode('utf-8')
+        get_rows.assert_not_called()
+        # once per export
+        assert get_shards.call_count == 2
+
+    def test_sharded_export_queryset(self):
+        for name in ('a', 'b', 'c'):
+            models.CSVOperation.record_operation(name, 'course', 'commit', '{}')
+        # serially, as the shard threads can't share the test transaction
+        processor = DummyProcessor(columns=['class_name', 'operation'])
+        shards = [('a', 'b'), ('c',)]
+        expected = 'class_name,operation\r\na,commit\r\nb,commit\r\nc,commit\r\n'
+        with mock.patch.object(processor, 'get_export_shards', return_value=shards), \
+                mock.patch.object(processor, 'get_shard_rows_to_export', side_effect=lambda shard: (
+                    models.CSVOperation.objects.filter(class_name__in=shard).order_by('class_name'))):
+            assert ''.join(processor.get_iterator()) == expected
+            assert b''.join(processor.get_buffered_iterator()) == expected.encode('utf-8')
+
+    def test_sharded_export_error(self):
+        processor = DummyShardedProcessor(export_workers=2)
+        with mock.patch.object(processor, 'get_shard_rows_to_export', side_effect=ValueError('bad shard')):
+            with self.assertRaises(ValueError):
+                list(processor.get_iterator())
+
     def test_checksum(self):
         processor = DummyChecksumProcessor()
         row = {
@@ -230,6 +467,43 @@ class CSVTestCase(TestCase):
         }
         assert processor.validate_row(equiv_row) is None
 
+    def test_checksum_block(self):
+        processor = DummyChecksumProcessor(export_batch_size=2)
+        rows = [{'foo': 1, 'bar': 'hello'}, {'foo': 0, 'bar': None}, {'foo': 'ü', 'bar': 3}]
+        assert processor._get_checksums(rows) == [  # pylint: disable=protected-access
+            processor._get_checksum(row) for row in rows  # pylint: disable=protected-access
+        ]
+        output = list(processor.get_iterator(rows=rows))
+        assert output[1:3] == ['1,hello,@cfb0\r\n', '0,,@fc43\r\n']
+
+    def test_checksum_block_respects_row_override(self):
+        class CustomRowProcessor(DummyChecksumProcessor):
+            def preprocess_export_row(self, row):
+                super().preprocess_export_row(row)
+                row['bar'] = 'custom'
+
+        output = list(CustomRowProcessor().get_iterator(rows=[{'foo': 1, 'bar': 'hello'}]))
+        assert output[1] == '1,custom,@cfb0\r\n'
+
+    def test_checksum_keyed(self):
+        processor = DummyChecksumProcessor(checksum_version=2)
+        row = {'foo': 1, 'bar': 'hello'}
+        processor.preprocess_export_row(row)
+        assert row['csum'].startswith('@v2:')
+        assert len(row['csum']) == len('@v2:') + processor.checksum_size
+        assert processor.validate_row(row) is None
+        # the column values are separated, so they can't be shifted between columns
+        with self.assertRaises(csv_processor.ValidationError):
+            processor.validate_row({'foo': '1h', 'bar': 'ello', 'csum': row['csum']})
+        with self.assertRaises(csv_processor.ValidationError):
+            DummyChecksumProcessor(checksum_version=2, secret='other').validate_row(row)
+
+    def test_checksum_legacy_accepted(self):
+        processor = DummyChecksumProcessor(checksum_version=2)
+        assert processor.validate_row({'foo': 1, 'bar': 'hello', 'csum': '@cfb0'}) is None
+        with self.assertRaises(csv_processor.ValidationError):
+            processor.validate_row({'foo': 1, 'bar': 'hello', 'csum': '@v2:cfb0'})
+
     def test_rollback(self):
         processor = DummyProcessor()
         processor.process_file(ContentFile(self.dummy_csv))
@@ -239,6 +513,336 @@ class CSVTestCase(TestCase):
         assert status['saved'] == 1
         assert status['error_messages'][0] == '4 is not allowed'
 
+    def test_commit_batches(self):
+        processor = DummyBatchProcessor()
+        processor.process_file(ContentFile('foo,bar\r\n1,1\r\n4,4\r\n2,2\r\n5,5\r\n6,6\r\n'))
+        assert processor.batches == [['1', '4'], ['2', '5'], ['6']]
+        status = processor.status()
+        assert status['saved'] == 2
+        assert dict(processor.error_messages) == {'4 is not allowed': [2], '5 is not allowed': [3, 4]}
+        assert [row['foo'] for row in status['error_rows']] == ['4', '2', '5']
+
+    def test_commit_atomic(self):
+        processor = DummyUserProcessor(commit_batch_size=2)
+        with CaptureQueriesContext(connection) as queries:
+            processor.process_file(ContentFile('foo,bar\r\n1,1\r\n4,4\r\n2,2\r\n'))
+        status = processor.status()
+        assert status['saved'] == 2
+        assert [row['foo'] for row in status['error_rows']] == ['4']
+        assert status['error_rows'][0]['error'] == '4 is not allowed'
+        usernames = get_user_model().objects.filter(username__startswith='row').values_list('username', flat=True)
+        assert sorted(usernames) == ['row1', 'row2']
+        # one savepoint for each batch and one for each row
+        savepoints = [query for query in queries.captured_queries if query['sql'].startswith('SAVEPOINT')]
+        assert len(savepoints) == 5
+
+    def test_commit_atomic_batch_failure(self):
+        processor = DummyUserProcessor(commit_batch_size=2)
+        with mock.patch.object(DummyUserProcessor, 'process_rows', autospec=True) as process_rows:
+            def create_then_fail(self, rows):
+                csv_processor.CSVProcessor.process_rows(self, rows)
+                raise ValueError('batch failed')
+            process_rows.side_effect = create_then_fail
+            processor.process_file(ContentFile('foo,bar\r\n1,1\r\n2,2\r\n'))
+        status = processor.status()
+        assert status['saved'] == 0
+        assert status['error_messages'] == ['batch failed']
+        assert not get_user_model().objects.filter(username__startswith='row').exists()
+
+    def test_resume_commit_from_checkpoint(self):
+        class WorkerLost(BaseException):
+            pass
+
+        committed = []
+        process_row = DummyDeferrableProcessor.process_row
+
+        def crash_on_5(self, row):
+            if row['foo'] == '5' and 'lost' not in committed:
+                committed.append('lost')
+                raise WorkerLost()
+            committed.append(row['foo'])
+            return process_row(self, row)
+
+        processor = DummyDeferrableProcessor(
+            checkpoint_interval=2, commit_batch_size=1, max_file_size=0, size_to_defer=10
+        )
+        processor.process_file(ContentFile('foo,bar\r\n1,1\r\n4,4\r\n2,2\r\n5,5\r\n6,6\r\n'), autocommit=False)
+        operation = processor.save()
+        with mock.patch.object(DummyDeferrableProcessor, 'process_row', crash_on_5):
+            with self.assertRaises(WorkerLost):
+                DummyDeferrableProcessor.load(operation.id).commit(operation_id=operation.id)
+            assert [checkpoint.last_row for checkpoint in operation.checkpoints.all()] == [2]
+            status = mixins.do_deferred_commit.delay(operation.id).get()
+        # rows 1 and 4 were committed before the checkpoint, row 2 was committed again
+        assert committed == ['1', '4', '2', 'lost', '2', '5', '6']
+        assert status['saved'] == 4
+        assert status['error_messages'] == ['4 is not allowed']
+        assert [row['foo'] for row in status['error_rows']] == ['4']
+        latest = DummyDeferrableProcessor.load(models.CSVOperation.get_latest(processor, 'test').id)
+        assert [rownum for rownum, __ in latest.rollback_rows] == [1, 3, 4, 5]
+        # only the marker of the saved commit is left
+        assert [checkpoint.committed_operation_id for checkpoint in operation.checkpoints.all()] == [
+            models.CSVOperation.get_latest(processor, 'test').id
+        ]
+        # the task delivered again after the commit was saved doesn't commit the rows again
+        assert mixins.do_deferred_commit.delay(operation.id).get()['saved'] == 4
+        assert committed == ['1', '4', '2', 'lost', '2', '5', '6']
+        # the resumed commit didn't save the staged state again
+        assert list(models.CSVOperation.objects.order_by('id').values_list('operation', flat=True)) == ['stage', 'stage', 'commit']
+
+    def test_deferred_commit_lock(self):
+        processor = DummyDeferrableProcessor(size_to_defer=10, max_file_size=0)
+        processor.process_file(ContentFile('foo,bar\r\n1,1\r\n2,2\r\n'), autocommit=False)
+        operation = processor.save()
+        lock_key = mixins.COMMIT_LOCK_KEY.format(operation.id)
+        # another worker is still committing the operation
+        cache.add(lock_key, 'other', 60)
+        with mock.patch.object(DummyDeferrableProcessor, 'process_row') as process_row, \
+                mock.patch.object(mixins.do_deferred_commit, 'retry', side_effect=Retry()) as retry:
+            with self.assertRaises(Retry):
+                mixins.do_deferred_commit.apply(args=(operation.id,), throw=True)
+        process_row.assert_not_called()
+        retry.assert_called_once_with(countdown=mixins.COMMIT_LOCK_RETRY_DELAY, max_retries=None)
+        assert cache.get(lock_key) == 'other'
+        cache.delete(lock_key)
+        status = mixins.do_deferred_commit.delay(operation.id).get()
+        assert status['saved'] == 2
+        assert cache.get(lock_key) is None
+
+    def test_split_payload(self):
+        processor = DummyDeferrableProcessor(split_payload=True, size_to_defer=10, max_file_size=0)
+        processor.process_file(ContentFile('foo,bar\r\n1,1\r\n2,2\r\n'), autocommit=False)
+        staged = processor.save()
+        state = json.loads(staged.read_data())
+        assert 'stage' not in state and 'result_data' not in state
+        assert set(state['__payloads__']) == {'stage', 'result_data'}
+        loaded = DummyDeferrableProcessor.load(staged.id)
+        assert [tuple(item) for item in loaded.stage] == list(processor.stage)
+        assert loaded.result_data == processor.result_data
+
+        processor.commit()
+        committed = processor.save()
+        # the unchanged results are not stored again
+        assert models.CSVPayload.objects.count() == 3
+        assert json.loads(committed.read_data())['__payloads__']['result_data'] == state['__payloads__']['result_data']
+        loaded = DummyDeferrableProcessor.load(committed.id)
+        assert not loaded.stage
+        assert loaded.status()['saved'] == 2
+
+    def test_save_result_errors(self):
+        processor = DummyDeferrableProcessor(max_file_size=0)
+        processor.process_file(ContentFile('foo,bar\r\n3,3\r\n1,1\r\n3,3\r\n'), autocommit=False)
+        operation = processor.save()
+        state = json.loads(operation.read_data())
+        # the saved results refer to the message instead of repeating it
+        assert [row['error'] for row in state['result_data']] == [0, '', 0]
+        loaded = DummyDeferrableProcessor.load(operation.id)
+        assert [row['error'] for row in loaded.result_data] == ['3 not allowed', '', '3 not allowed']
+        assert loaded.status()['error_rows'] == processor.status()['error_rows']
+
+    def test_compact_results(self):
+        contents = 'foo,bar\r\n1,1\r\n4,4\r\n2,2\r\n5,5\r\n'
+
+        def no_action_on_5(self, row):
+            return None if row['foo'] == '5' else row
+
+        with mock.patch.object(DummyProcessor, 'preprocess_row', no_action_on_5):
+            expected = DummyProcessor(max_file_size=0)
+            expected.process_file(ContentFile(contents))
+            processor = DummyProcessor(max_file_size=0, compact_results=True)
+            processor.process_file(ContentFile(contents))
+        assert not processor.result_data
+        assert processor.no_action_rows == [4]
+        assert list(processor.get_iterator(error_data=True)) == list(expected.get_iterator(error_data=True))
+        report = list(processor.get_iterator(error_data=True, errors_only=True))
+        assert report == list(expected.get_iterator(error_data=True, errors_only=True))
+        assert [line.split(',')[0] for line in report] == ['foo', '4']
+        assert processor.status() == expected.status()
+
+    def test_compact_results_truncated(self):
+        contents = 'foo,bar\r\n3,3\r\n3,3\r\n1,1\r\n2,2\r\n'
+        expected = DummyProcessor(max_file_size=0, abort_max_errors=2)
+        expected.process_file(ContentFile(contents))
+        processor = DummyProcessor(max_file_size=0, abort_max_errors=2, compact_results=True)
+        processor.process_file(ContentFile(contents))
+        assert processor.status()['truncated']
+        report = list(processor.get_iterator(error_data=True))
+        assert report == list(expected.get_iterator(error_data=True))
+        assert [line.split(',')[0] for line in report] == ['foo', '3', '3']
+
+    def test_compact_results_rejected_file(self):
+        processor = DummyProcessor(max_file_size=0, compact_results=True)
+        processor.process_file(ContentFile('bar\r\n1\r\n2\r\n'))
+        assert processor.get_upload() is None
+        assert list(processor.get_iterator(error_data=True)) == ['foo,bar,status,error\r\n']
+        assert processor.status()['error_messages'] == ['Missing column: foo']
+
+    def test_compact_results_unseekable_stream(self):
+        class Unseekable(io.BytesIO):
+            def seekable(self):
+                return False
+
+            def seek(self, *args):
+                raise io.UnsupportedOperation('seek')
+
+        contents = b'foo,bar\r\n1,1\r\n3,3\r\n2,2\r\n'
+        processor = DummyProcessor(
+            max_file_size=0, compact_results=True, streaming=True, projected_reader=True, stream_window_size=1
+        )
+        processor.process_file(Unseekable(contents))
+        assert processor.get_upload().read() == contents
+        assert not processor.result_data
+        report = b''.join(processor.get_buffered_iterator(error_data=True))
+        assert report == b'foo,bar,status,error\r\n1,1,Success,\r\n3,3,Failure,3 not allowed\r\n2,2,Success,\r\n'
+
+    def test_compact_results_deferrable(self):
+        contents = 'foo,bar\r\n1,1\r\n3,3\r\n2,2\r\n'
+        processor = DummyDeferrableProcessor(max_file_size=0, size_to_defer=10, compact_results=True)
+        processor.process_file(ContentFile(contents), autocommit=False)
+        operation = models.CSVOperation.objects.get(pk=processor.saved_error_id)
+        assert operation.payloads.get().key == processor.upload_key
+        loaded = DummyDeferrableProcessor.load(operation.id)
+        assert not loaded.result_data
+        assert [row['foo'] for row in loaded.status()['error_rows']] == ['3']
+        report = list(loaded.get_buffered_iterator(error_data=True))
+        assert report == [b'foo,bar,status,error\r\n1,1,Success,\r\n3,3,Failure,3 not allowed\r\n2,2,Success,\r\n']
+
+    def test_compact_results_closes_stored_upload(self):
+        processor = DummyDeferrableProcessor(max_file_size=0, size_to_defer=10, compact_results=True)
+        processor.process_file(ContentFile('foo,bar\r\n1,1\r\n3,3\r\n'), autocommit=False)
+        loaded = DummyDeferrableProcessor.load(processor.saved_error_id)
+        upload = loaded.get_upload()
+        with mock.patch.object(DummyDeferrableProcessor, 'get_upload', return_value=upload):
+            assert [row['foo'] for row in loaded.status()['error_rows']] == ['3']
+        assert upload.closed
+        # the copy kept in memory is reused
+        processor.status()
+        assert not processor.get_upload().closed
+
+    @ddt.data(
+        ({}, 10),
+        ({'abort_max_errors': 3}, 5),
+        ({'abort_consecutive_errors': 3}, 7),
+        ({'abort_max_error_ratio': 0.5, 'abort_min_rows': 6}, 6),
+        ({'abort_max_errors': 1, 'preprocess_workers': 2, 'preprocess_chunk_size': 2}, 2),
+    )
+    @ddt.unpack
+    def test_abort_on_errors(self, policy, rows_read):
+        contents = 'foo,bar\r\n' + ''.join(f'{foo},1\r\n' for foo in '1331333311')
+        processor = DummyProcessor(max_file_size=0, **policy)
+        with mock.patch.object(DummyProcessor, 'validate_row', autospec=True,
+                               side_effect=DummyProcessor.validate_row) as validate_row:
+            processor.process_file(ContentFile(contents))
+        status = processor.status()
+        assert status['total'] == rows_read
+        assert status['truncated'] == (rows_read < 10)
+        if status['truncated']:
+            assert validate_row.call_count <= rows_read + 2
+            assert status['error_messages'][-1] == f'Stopped reading the file after {rows_read} rows: too many errors'
+        assert not status['saved']
+
+    def test_error_ranges(self):
+        contents = 'foo,bar\r\n' + '3,3\r\n' * 5 + '1,1\r\n' + '3,3\r\n' * 2
+        processor = DummyDeferrableProcessor(max_file_size=0, size_to_defer=10)
+        processor.process_file(ContentFile(contents), autocommit=False)
+        rows = processor.error_messages['3 not allowed']
+        assert rows.ranges == [[1, 5], [7, 8]]
+        assert len(rows) == 7
+        assert rows == [1, 2, 3, 4, 5, 7, 8]
+        errors = [row['error'] for row in processor.status()['error_rows']]
+        assert len({id(error) for error in errors}) == 1
+        state = json.loads(models.CSVOperation.objects.get(pk=processor.saved_error_id).read_data())
+        assert state['error_messages'] == {'3 not allowed': [[1, 5], [7, 8]]}
+        loaded = DummyDeferrableProcessor.load(processor.saved_error_id)
+        assert loaded.error_messages == processor.error_messages
+        assert loaded.status()['error_messages'] == ['3 not allowed']
+
+    def test_load_error_row_lists(self):
+        processor = DummyProcessor(error_messages={'bad row': [0, 2, 3]})
+        assert processor.error_messages['bad row'].ranges == [[0, 0], [2, 3]]
+        processor.add_error('bad row', 4)
+        assert list(processor.error_messages['bad row']) == [0, 2, 3, 4]
+
+    def test_commit_batch_rollback_rows(self):
+        processor = DummyProcessor(commit_batch_size=2, max_file_size=0)
+        processor.process_file(ContentFile('foo,bar\r\n1,1\r\n4,4\r\n2,2\r\n'))
+        assert processor.status()['saved'] == 2
+        assert [rownum for rownum, __ in processor.rollback_rows] == [1, 3]
+        assert processor.result_data[1]['error'] == '4 is not allowed'
+
+    def test_streaming(self):
+        processor = DummyProcessor(streaming=True, stream_window_size=2, max_file_size=0)
+        processor.process_file(ContentFile('foo,bar\r\n1,1\r\n3,3\r\n4,4\r\n2,2\r\n5,5\r\n'))
+        status = processor.status()
+        assert status['total'] == 5
+        assert status['processed'] == 4
+        assert status['saved'] == 3
+        assert not processor.stage
+        assert [row['foo'] for row in processor.result_data] == ['3', '4']
+        assert [row['error'] for row in processor.result_data] == ['3 not allowed', '4 is not allowed']
+        assert dict(processor.error_messages) == {'3 not allowed': [2], '4 is not allowed': [3]}
+        assert [rownum for rownum, __ in processor.rollback_rows] == [1, 4, 5]
+
+    def test_streaming_deferrable(self):
+        processor = DummyDeferrableProcessor(streaming=True, max_file_size=0)
+        processor.process_file(ContentFile('foo,bar\r\n1,1\r\n3,3\r\n'))
+        status = processor.status()
+        assert status['saved'] == 1
+        assert not status['waiting']
+        operation = models.CSVOperation.get_latest(processor, processor.get_unique_path())
+        assert operation.operation == 'commit'
+        assert status['saved_error_id'] == operation.id
+
+    @ddt.data('thread', 'process')
+    def test_parallel_preprocess(self, executor):
+        contents = 'foo,bar\r\n' + ''.join(f'{i % 5},{i}\r\n' for i in range(1, 30))
+        serial = DummyProcessor(max_file_size=0)
+        serial.process_file(ContentFile(contents), autocommit=False)
+        parallel = DummyProcessor(
+            max_file_size=0, preprocess_workers=2, preprocess_executor=executor, preprocess_chunk_size=4
+        )
+        parallel.process_file(ContentFile(contents), autocommit=False)
+        assert parallel.result_data == serial.result_data
+        assert list(parallel.stage) == list(serial.stage)
+        assert parallel.error_messages == serial.error_messages
+        assert parallel.status() == serial.status()
+
+    def test_parallel_preprocess_compact_results(self):
+        contents = 'foo,bar\r\n' + ''.join(f'{i % 5},{i}\r\n' for i in range(1, 10))
+        serial = DummyProcessor(max_file_size=0, compact_results=True)
+        serial.process_file(ContentFile(contents), autocommit=False)
+        parallel = DummyProcessor(
+            max_file_size=0, compact_results=True, preprocess_workers=2, preprocess_executor='process'
+        )
+        parallel.process_file(ContentFile(contents), autocommit=False)
+        assert list(parallel.get_iterator(error_data=True)) == list(serial.get_iterator(error_data=True))
+
+    @ddt.data('thread', 'process')
+    def test_parallel_preprocess_language(self, executor):
+        contents = 'foo,bar\r\n' + ''.join(f'{i % 5},{i}\r\n' for i in range(1, 30))
+        with translation.override('fr'):
+            serial = DummyTranslatedProcessor()
+            serial.process_file(ContentFile(contents), autocommit=False)
+            parallel = DummyTranslatedProcessor(
+                preprocess_workers=2, preprocess_executor=executor, preprocess_chunk_size=4
+            )
+            with mock.patch.object(csv_processor, '_close_worker_connections',
+                                   wraps=csv_processor._close_worker_connections) as close:
+                parallel.process_file(ContentFile(contents), autocommit=False)
+        assert parallel.status()['error_messages'] == ['Ce champ est obligatoire.']
+        assert parallel.status() == serial.status()
+        closed = close.call_args.args[0]
+        if executor == 'thread':
+            # each thread's connections are closed
+            assert len(closed) == 2 * len(connections.all())
+        else:
+            assert not closed
+
+    def test_parallel_preprocess_bad_executor(self):
+        processor = DummyProcessor(preprocess_workers=2, preprocess_executor='fiber')
+        with self.assertRaises(ValueError):
+            processor.process_file(ContentFile(self.dummy_csv))
+
     def test_defer(self):
         processor = DummyDeferrableProcessor()
         processor.test_set = {1, 2, 3}
@@ -246,6 +850,106 @@ class CSVTestCase(TestCase):
         status = processor.status()
         assert status['saved'] == 2
 
+    def test_stage_survives_save_and_load(self):
+        processor = DummyDeferrableProcessor()
+        processor.process_file(ContentFile(self.dummy_csv), autocommit=False)
+        operation = processor.save()
+        loaded = DummyDeferrableProcessor.load(operation.id)
+        assert isinstance(loaded.stage, deque)
+        assert [rownum for rownum, __ in loaded.stage] == [1, 2]
+        loaded.commit(running_task=True)
+        assert loaded.status()['saved'] == 2
+        assert not loaded.stage
+        assert [rownum for rownum, __ in loaded.rollback_rows] == [1, 2]
+
+    def test_defer_sharded(self):
+        processor = DummyDeferrableProcessor(commit_shards=2, max_file_size=0)
+        processor.process_file(ContentFile('foo,bar\r\n1,1\r\n4,4\r\n2,2\r\n5,5\r\n6,6\r\n'))
+        status = processor.status()
+        assert status['saved'] == 4
+        assert status['error_messages'] == ['4 is not allowed']
+        assert [row['foo'] for row in status['error_rows']] == ['4']
+        assert len(processor.shard_task_ids) == 2
+        operations = models.CSVOperation.objects.order_by('id')
+        assert [op.operation for op in operations] == [
+            'stage', 'shard', 'shard', 'shard_commit', 'shard_commit', 'commit'
+        ]
+        merged = DummyDeferrableProcessor.load(operations.last().id)
+        assert merged.saved_rows == 4
+        assert not merged.stage
+        assert [rownum for rownum, __ in merged.rollback_rows] == [1, 3, 4, 5]
+        assert merged.error_messages == {'4 is not allowed': [2]}
+
+    def test_report_progress(self):
+        processor = DummyProcessor(commit_batch_size=2, progress_interval_rows=2, max_file_size=0)
+        with mock.patch.object(processor, 'report_progress') as report_progress:
+            processor.process_file(ContentFile('foo,bar\r\n1,1\r\n4,4\r\n2,2\r\n5,5\r\n6,6\r\n'))
+        progress = [call.args[0] for call in report_progress.call_args_list]
+        assert [(p['total'], p['processed'], p['saved'], p['errors']) for p in progress] == [
+            (5, 2, 1, 1), (5, 4, 3, 1),
+        ]
+        assert all(p['rows_per_second'] for p in progress)
+
+    def test_deferred_progress_task_state(self):
+        processor = DummyDeferrableProcessor(progress_interval_rows=1)
+        processor.process_file(ContentFile(self.dummy_csv), autocommit=False)
+        task = mock.Mock()
+        task.request.id = 'task-id'
+        task.request.is_eager = False
+        processor.commit(running_task=task)
+        assert task.update_state.call_count == 1
+        assert task.update_state.call_args.kwargs['state'] == 'PROGRESS'
+        assert task.update_state.call_args.kwargs['meta']['saved'] == 2
+
+    @mock.patch('super_csv.mixins.AsyncResult')
+    def test_get_progress(self, patch_result):
+        patch_result.side_effect = [
+            mock.Mock(state='PROGRESS', info={'total': 4, 'processed': 2, 'saved': 2, 'errors': 0}),
+            mock.Mock(state='SUCCESS', info={}),
+            mock.Mock(state='PROGRESS', info={'total': 4, 'processed': 3, 'saved': 1, 'errors': 2}),
+        ]
+        progress = DummyDeferrableProcessor.get_progress('a', 'b', 'c')
+        assert progress == {'total': 8, 'processed': 5, 'saved': 3, 'errors': 2}
+        patch_result.side_effect = [mock.Mock(state='PENDING', info=None)]
+        assert DummyDeferrableProcessor.get_progress('a') is None
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_save_load_msgpack(self):
+        processor = DummyDeferrableProcessor(state_codec='msgpack')
+        processor.process_file(ContentFile(self.dummy_csv), autocommit=False)
+        operation = processor.save()
+        assert operation.read_data().startswith(b'SCSV:msgpack')
+        loaded = DummyDeferrableProcessor.load(operation.id)
+        assert [rownum for rownum, __ in loaded.stage] == [1, 2]
+        assert loaded.result_data == processor.result_data
+
+    def test_committed_history_from_summary(self):
+        for __ in range(3):
+            processor = DummyDeferrableProcessor()
+            processor.process_file(ContentFile(self.dummy_csv))
+        with self.assertNumQueries(1), mock.patch.object(models.CSVOperation, 'read_data') as read_data:
+            history = processor.get_committed_history()
+        read_data.assert_not_called()
+        assert len(history) == 3
+        assert history[0]['data'] == {'total_rows': 2, 'processed_rows': 2, 'saved_rows': 2}
+
+    def test_committed_history_page(self):
+        for __ in range(5):
+            processor = DummyDeferrableProcessor()
+            processor.process_file(ContentFile(self.dummy_csv))
+        expected = [item['id'] for item in processor.get_committed_history()]
+        ids = []
+        cursor = None
+        for __ in range(3):
+            with self.assertNumQueries(1):
+                page = processor.get_committed_history_page(page_size=2, cursor=cursor)
+            ids.extend(item['id'] for item in page['results'])
+            cursor = page['next_cursor']
+        assert cursor is None
+        assert ids == expected
+        with self.assertRaises(ValueError):
+            processor.get_committed_history_page(cursor='not a cursor')
+
     def test_defer_too_small(self):
         processor = DummyDeferrableProcessor()
         processor.process_file(ContentFile('foo,bar\r\n1,2\r\n'))
@@ -3,21 +3,124 @@
 Tests for the `super-csv` models module.
 """
 
+import io
+import unittest
+from datetime import timedelta
 from unittest.mock import patch
 
+import ddt
 from django.conf import settings
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils.timezone import now
 
-from super_csv.models import CSVOperation
+from super_csv.compression import zstandard
+from super_csv.models import EXPIRE_LOCK_KEY, CSVOperation, CSVPayload
 
 
+@ddt.ddt
 class TestModel(TestCase):
     def test_expire_data(self):
         operation = CSVOperation.record_operation('test', 1, 'save', "some data")
         operation_id = operation.id
-        with patch.object(settings, 'CSV_EXPIRATION_DAYS', -10):
+        with patch.object(settings, 'CSV_EXPIRATION_DAYS', -10), self.captureOnCommitCallbacks(execute=True):
             operation.operation = 'test save'
             operation.id = 3
             operation.save()
         operation = CSVOperation.objects.get(pk=operation_id)
         assert operation.data.name == ''
+
+    def test_expire_data_batches(self):
+        operations = [CSVOperation.record_operation('test', 1, 'save', 'some data') for __ in range(5)]
+        names = [operation.data.name for operation in operations]
+        storage = operations[0].data.storage
+        with patch.object(storage, 'delete', wraps=storage.delete) as delete:
+            assert CSVOperation.expire_data(-1, batch_size=2) == 5
+        assert sorted(call.args[0] for call in delete.call_args_list) == sorted(names)
+        assert not any(storage.exists(name) for name in names)
+        assert set(CSVOperation.objects.values_list('data', 'expired')) == {('', True)}
+        # expired operations are not scanned again
+        with patch.object(storage, 'delete') as delete:
+            assert CSVOperation.expire_data(-1) == 0
+        delete.assert_not_called()
+
+    def test_expire_data_payloads(self):
+        shared, expired_only = CSVPayload.store(b'[1]'), CSVPayload.store(b'[2]')
+        assert CSVPayload.store(b'[1]') == shared
+        expired = CSVOperation.record_operation('test', 1, 'save', 'some data', payloads=[shared, expired_only])
+        kept = CSVOperation.record_operation('test', 1, 'save', 'some data', payloads=[shared])
+        CSVOperation.objects.filter(pk=expired.pk).update(modified=now() - timedelta(days=10))
+        CSVPayload.objects.update(created=now() - timedelta(days=10))
+        # payloads that are newer than the expiration may be about to be referenced
+        unreferenced = CSVPayload.store(b'[3]')
+        storage = shared.data.storage
+        assert CSVOperation.expire_data(5) == 1
+        assert list(CSVPayload.objects.order_by('pk')) == [shared, unreferenced]
+        assert storage.exists(shared.data.name)
+        assert not storage.exists(expired_only.data.name)
+        assert list(kept.payloads.all()) == [shared]
+        kept.delete()
+        # reusing a payload refreshes it, so it isn't expired before the new operation references it
+        assert CSVPayload.store(b'[1]') == shared
+        assert CSVOperation.expire_data(5) == 0
+        assert storage.exists(shared.data.name)
+        CSVPayload.objects.filter(pk=shared.pk).update(created=now() - timedelta(days=10))
+        assert CSVOperation.expire_data(5) == 0
+        assert list(CSVPayload.objects.all()) == [unreferenced]
+        assert not storage.exists(shared.data.name)
+        unreferenced.data.delete()
+
+    def test_expire_data_keeps_failed_deletes(self):
+        operation = CSVOperation.record_operation('test', 1, 'save', 'some data')
+        with patch.object(operation.data.storage, 'delete', side_effect=OSError):
+            assert CSVOperation.expire_data(-1) == 0
+        assert CSVOperation.objects.get(pk=operation.pk).data.name == operation.data.name
+        operation.delete()
+
+    def test_expire_data_locked(self):
+        operation = CSVOperation.record_operation('test', 1, 'save', 'some data')
+        cache.add(EXPIRE_LOCK_KEY, True)
+        try:
+            assert CSVOperation.expire_data(-1) == 0
+        finally:
+            cache.delete(EXPIRE_LOCK_KEY)
+        assert CSVOperation.objects.get(pk=operation.pk).data.name == operation.data.name
+        operation.delete()
+
+    def test_expire_data_lock_taken_over(self):
+        def take_over_lock(*args):
+            # the lock timed out and another run took it
+            cache.set(EXPIRE_LOCK_KEY, 'other')
+
+        try:
+            with patch.object(CSVOperation, '_delete_unreferenced_payloads', side_effect=take_over_lock):
+                CSVOperation.expire_data(-1)
+            assert cache.get(EXPIRE_LOCK_KEY) == 'other'
+        finally:
+            cache.delete(EXPIRE_LOCK_KEY)
+
+    @ddt.data((None, b'{'), ('gzip', b'\x1f\x8b'), ('zstd', b'\x28\xb5\x2f\xfd'))
+    @ddt.unpack
+    def test_compressed_data(self, method, header):
+        if method == 'zstd' and zstandard is None:
+            raise unittest.SkipTest('zstandard is not installed')
+        data = '{"total_rows": 1}' * 100
+        with override_settings(CSV_STORAGE_COMPRESSION=method):
+            operation = CSVOperation.record_operation('test', 1, 'save', data)
+        with operation.data.open('rb') as stored:
+            assert stored.read().startswith(header)
+        # the format is detected from the data, whatever the current setting
+        assert operation.read_data() == data.encode()
+        operation.delete()
+
+    @ddt.data(None, 'gzip', 'zstd')
+    def test_payload_store_file(self, method):
+        if method == 'zstd' and zstandard is None:
+            raise unittest.SkipTest('zstandard is not installed')
+        data = b'foo,bar\r\n' + b'1,2\r\n' * 1000
+        with override_settings(CSV_STORAGE_COMPRESSION=method):
+            payload = CSVPayload.store_file(io.BytesIO(data))
+        assert payload == CSVPayload.store(data)
+        with payload.open_data() as stored:
+            assert stored.read() == data
+        payload.data.delete()
@@ -4,10 +4,13 @@ Tests for the `super-csv` mixins module.
 """
 
 import json
+import unittest
+from unittest import mock
 
 from django.test import TestCase
 
 from super_csv.serializers import CSVOperation, CSVOperationSerializer
+from super_csv.state_codecs import encode_state, msgpack
 
 
 class SerializerTestCase(TestCase):
@@ -36,6 +39,21 @@ class SerializerTestCase(TestCase):
         self.assertDictEqual(operation_data, self.data)
         self.assertNotIn('error_message', operation_data)
 
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_get_data_encoded_state(self):
+        operation = CSVOperation.record_operation('some_name', 'course_id', 'save', encode_state(self.data, 'msgpack'))
+        data = CSVOperationSerializer(operation).data['data']
+        self.assertDictEqual(data, self.data)
+
+    def test_get_data_from_summary(self):
+        operation = CSVOperation.record_operation(
+            'some_name', 'course_id', 'save', json.dumps({}), summary=self.data
+        )
+        with mock.patch.object(CSVOperation, 'read_data') as read_data:
+            data = CSVOperationSerializer(operation).data['data']
+        read_data.assert_not_called()
+        self.assertDictEqual(data, self.data)
+
     def test_get_data_fail(self):
         # test error
         CSVOperation.expire_data(-1)
@@ -0,0 +1,40 @@
+"""
+Tests for the `super-csv` state_codecs module.
+"""
+
+import unittest
+
+import simplejson as json
+from django.test import TestCase
+
+from super_csv.exceptions import StateCodecError
+from super_csv.state_codecs import decode_state, encode_state, msgpack
+
+
+class StateCodecTestCase(TestCase):
+    """
+    Tests for encode_state and decode_state.
+    """
+    state = {
+        'stage': [[1, {'foo': '1', 'bar': None}]],
+        'error_messages': {'bad row': [2, 3]},
+        '__class__': ['tests.test_csv', 'DummyDeferrableProcessor'],
+    }
+
+    def test_json_is_unprefixed(self):
+        data = encode_state(self.state)
+        assert data == json.dumps(self.state).encode('utf8')
+        assert decode_state(data) == self.state
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        data = encode_state(self.state, 'msgpack')
+        assert data.startswith(b'SCSV:msgpack\n')
+        assert len(data) < len(encode_state(self.state))
+        assert decode_state(data) == self.state
+
+    def test_unknown_codec(self):
+        with self.assertRaises(StateCodecError):
+            encode_state(self.state, 'yaml')
+        with self.assertRaises(StateCodecError):
+            decode_state(b'SCSV:yaml\n{}')